@@ -1,5 +1,10 @@
-import requests, json, polyline, time, threading
+import json, polyline
+from math import ceil
 from utils import distance_km, interpolate_segments
+from response_cache import get_cache
+from http_client import get_client
+from rate_limiter import get_limiter
+from distance_matrix import DistanceMatrix
 
 def extract_michelin_points(points, data):
     white_list = ["C", "V", "P", "lim", "eTrafic"]
@@ -23,10 +28,15 @@ class Michelin():
         else:
             self.auth_key = auth_key
 
+    @property
+    def cache(self):
+        return get_cache()
+
     def geocode(self, query, point = None):
         url = "https://secure-apir.viamichelin.com/apir/1/geocode1f.json2"
         data = {"query":query,"obfuscation":False,"ie":"UTF-8","charset":"UTF-8","authKey":self.auth_key,"lg":"fra","nocache":1631885079421,"protocol":"https"}
-        req = requests.get(url, params = data)
+        get_limiter("michelin").acquire()
+        req = get_client().get(url, params = data)
         req.raise_for_status()
         req_data = req.json()
         
@@ -47,7 +57,8 @@ class Michelin():
             "center": "{}:{}".format(lon, lat),
             "showHT": True,"obfuscation": False,"ie": "UTF-8","charset": "UTF-8","authKey": self.auth_key,"lg": "eng","protocol": "https"
         }
-        req = requests.get(url, params = data)
+        get_limiter("michelin").acquire()
+        req = get_client().get(url, params = data)
         req.raise_for_status()
         req_data = req.json()
         
@@ -61,17 +72,12 @@ class Michelin():
             "distUnit":"m","itit":0,"veht":0,"avoidExpressWays":False,"avoidBorders":False,"avoidTolls":False,"avoidCCZ":False,"avoidORC":False,"avoidPass":False,"avoidClosedRoad":True,"currency":"EUR","favMotorways":False,"fuelCost":fuel_cost,"itineraryFuelType":"petrol","fullMapOpt":"300:300:true:true:true","indemnite":0,"stepMapOpt":"300:300:true:true:true","traffic":"ALL","isCostFctUsingTraffic":False,"sortFDRsByTraffic":False,"itineraryVehiculeType":"hatchback","wCaravan":False,"withSecurityAdv":False,"shouldUseNewEngine":False,"shouldUseTraffic":False,"costCategory":"car","isMotorVehicle":True,"lg":"eng","obfuscation":False,"charset":"UTF-8","ie":"UTF-8","nocache":1632567830744,"protocol":"https","callback":"JSE.HTTP.asyncRequests[3]._scriptLoaded"
         }
         
-        tries = 0
-        
-        while tries < 10:
-            try:
-                req = requests.get(url, params = data)
-            except requests.exceptions.ConnectionError:
-                tries += 1
-                continue
-            else:
-                break
-        
+        cache_params = {"waypoints": waypoints, "fuel_cost": fuel_cost}
+        cached = self.cache.get("michelin_directions", cache_params)
+        if cached is not None: return cached
+
+        get_limiter("michelin").acquire()
+        req = get_client().get(url, params = data)
         req.raise_for_status()
         data = json.loads(req.content[req.content.decode("utf-8").index("{"):-1])
         
@@ -95,71 +101,109 @@ class Michelin():
             "points": points
         }
 
+        self.cache.set("michelin_directions", cache_params, output)
         return output
 
     def directions_multithreaded(self, route_list):
-        output = [None]*len(route_list)
-
-        def thread_directions(waypoints, output, i):
-            output[i] = self.directions(waypoints)
-
-        threads = [threading.Thread(target=thread_directions, args=(waypoints, output, i)) for i, waypoints in enumerate(route_list)]
-        [thread.start() for thread in threads]
-        [thread.join() for thread in threads]
-
-        return output
+        return get_client().map(self.directions, route_list)
 
 class OpenRouteService():
     
     def __init__(self, config_path = "config.json"):
         with open(config_path, "r") as f:
-            self.api_key = json.load(f)["openrouteservice_key"]
-        self.session = requests.Session()
-        self.session.headers.update({'Authorization': self.api_key, "Accept": "application/json"})
-        
-    def post(self, url, json = None):
-        tries = 0
-        status_code = 429
-        while status_code == 429 and tries < 4:
-            req = self.session.post(url, json = json)
-            tries += 1  
-            status_code = req.status_code
-            
-            if status_code == 429:
-                print("Waiting 30 secs...")
-                time.sleep(30)
+            config = json.load(f)
+        self.config_path = config_path
+        self.api_key = config["openrouteservice_key"]
+        self.matrix_max_cells = config.get("ors_matrix_max_cells", 3500)
+        self.headers = {'Authorization': self.api_key, "Accept": "application/json"}
+        
+    @property
+    def cache(self):
+        return get_cache(self.config_path)
+
+    def request(self, method, url, limiter_name, **kwargs):
+        limiter = get_limiter(limiter_name, self.config_path)
+        for tries in range(4):
+            limiter.wait()
+            req = get_client().request(method, url, headers = self.headers, **kwargs)
+            if req.status_code != 429:
+                # Rejected requests are not charged to the daily quota
+                limiter.consume()
+                break
+            retry_after = req.headers.get("Retry-After")
+            limiter.throttled(float(retry_after) if retry_after is not None and retry_after.isdigit() else 60)
                 
         return req
+
+    def post(self, url, json = None, limiter_name = "ors_directions"):
+        return self.request("POST", url, limiter_name, json = json)
     
-    def matrix(self, destinations):
+    def matrix_chunk_sizes(self, nb_sources):
+        sources_chunk_size = max(1, min(nb_sources, self.matrix_max_cells))
+        return sources_chunk_size, max(1, self.matrix_max_cells // sources_chunk_size)
+
+    def matrix_requests(self, sources, destinations):
+        # Number of ORS matrix requests matrix_block would send, cached columns are free
+        missing = [destination for destination in destinations if self.cache.get("ors_matrix_column", {"sources": sources, "destination": destination}) is None]
+        if len(sources) == 0 or len(missing) == 0: return 0
+
+        sources_chunk_size, destinations_chunk_size = self.matrix_chunk_sizes(len(sources))
+        return ceil(len(sources) / sources_chunk_size) * ceil(len(missing) / destinations_chunk_size)
+
+    def matrix_block(self, sources, destinations):
         url = "https://api.openrouteservice.org/v2/matrix/driving-car"
+
+        durations = [[None]*len(destinations) for _ in sources]
+        distances = [[None]*len(destinations) for _ in sources]
+
+        missing_destinations = list()
+        for j, destination in enumerate(destinations):
+            column = self.cache.get("ors_matrix_column", {"sources": sources, "destination": destination})
+            if column is None:
+                missing_destinations.append(j)
+                continue
+            for i in range(len(sources)):
+                durations[i][j], distances[i][j] = column["durations"][i], column["distances"][i]
+
+        sources_chunk_size, destinations_chunk_size = self.matrix_chunk_sizes(len(sources))
+
+        for sources_start in range(0, len(sources), sources_chunk_size):
+            sources_chunk = sources[sources_start:sources_start + sources_chunk_size]
+            for destinations_start in range(0, len(missing_destinations), destinations_chunk_size):
+                destination_ids = missing_destinations[destinations_start:destinations_start + destinations_chunk_size]
+                destinations_chunk = [destinations[j] for j in destination_ids]
+
+                locations = list()
+                for location in sources_chunk + destinations_chunk:
+                    if list(location) not in locations: locations.append(list(location))
+
+                req = self.post(url, limiter_name = "ors_matrix", json = {
+                    "locations": [location[::-1] for location in locations],
+                    "sources": [locations.index(list(location)) for location in sources_chunk],
+                    "destinations": [locations.index(list(location)) for location in destinations_chunk],
+                    "metrics": ["distance", "duration"]
+                })
+                req.raise_for_status()
+                raw_data = req.json()
+
+                for i in range(len(sources_chunk)):
+                    for chunk_j, j in enumerate(destination_ids):
+                        durations[sources_start + i][j] = raw_data["durations"][i][chunk_j]
+                        distances[sources_start + i][j] = raw_data["distances"][i][chunk_j]
+
+        for j in missing_destinations:
+            self.cache.set("ors_matrix_column", {"sources": sources, "destination": destinations[j]}, {
+                "durations": [durations[i][j] for i in range(len(sources))],
+                "distances": [distances[i][j] for i in range(len(sources))]
+            })
+
+        return {"durations": durations, "distances": distances}
+
+    def matrix(self, destinations):
+        locations = [list(location) for location in destinations.values()]
+        raw_data = self.matrix_block(locations, locations)
         
-        destinations_list = [dest_location[::-1] for dest_name, dest_location in destinations.items()]
-        req = self.post(url, json = {"locations":destinations_list,"metrics":["distance","duration"]})
-        
-        req.raise_for_status()
-        
-        raw_data = req.json()
-        
-        matrix_data = dict()
-        for name_source, location_source in destinations.items():
-            
-            source_id = destinations_list.index(location_source[::-1])
-            
-            matrix_data[name_source] = dict()
-            
-            for name_dest, location_dest in destinations.items():
-                
-                dest_id = destinations_list.index(location_dest[::-1])
-                
-                trip_dict = {
-                    "distance": raw_data["distances"][source_id][dest_id],
-                    "duration": raw_data["durations"][source_id][dest_id]
-                }
-                
-                matrix_data[name_source][name_dest] = trip_dict
-        
-        return matrix_data
+        return DistanceMatrix(destinations.keys(), raw_data["durations"], raw_data["distances"])
     
     def route(self, waypoints):
         url = "https://api.openrouteservice.org/v2/directions/driving-car"
@@ -168,6 +212,9 @@ class OpenRouteService():
             "extra_info":["tollways"],"instructions":"false","maneuvers":"false","units":"m","geometry":"true"
         }
         
+        cached = self.cache.get("ors_route", {"waypoints": waypoints})
+        if cached is not None: return cached
+
         req = self.post(url, json = data)
         
         if req.status_code == 404:
@@ -179,7 +226,8 @@ class OpenRouteService():
         del data["routes"]
         
         data["route"]["geometry"] = polyline.decode(data["route"]["geometry"])
-        
+
+        self.cache.set("ors_route", {"waypoints": waypoints}, data)
         return data
 
     def set_driver_route(self, driver, covoits):
@@ -202,7 +250,10 @@ class OpenRouteService():
             "boundary.circle.radius": 600
         }
         
-        req = self.session.get(url, params = params)
+        cached = self.cache.get("ors_geocode", {"text": query})
+        if cached is not None: return cached
+
+        req = self.request("GET", url, "ors_geocode", params = params)
         req.raise_for_status()
         
         raw_data = req.json()
@@ -219,7 +270,8 @@ class OpenRouteService():
                 properties["country"] if "country" in properties.keys() else ""
             )
         }
-        
+
+        self.cache.set("ors_geocode", {"text": query}, output)
         return output
     
 class InvalidLocationError(Exception):
@@ -1,12 +1,19 @@
-from bs4 import BeautifulSoup
-import requests, re
+from bs4 import BeautifulSoup, SoupStrainer
+import re
+from http_client import get_client
+from response_cache import get_cache
 from datetime import datetime, timedelta
 from enum import Enum
 import pickle
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_URL = "https://www.gites-de-france.com"
 BASE_SEARCH_URL = "https://www.gites-de-france.com/fr/search"
 RESULTS_PER_PAGES = 20
+TILES_STRAINER = SoupStrainer("section", id = "markup-tiles")
+RESULTS_COUNT_STRAINER = SoupStrainer("p")
+PRICE_SORT_FIELD = "price"
 
 class FilterOrder(Enum):
     ASC = 1
@@ -38,9 +45,24 @@ class Regions(Enum):
     PROVENCE_ALPES_COTE_DAZURE = (17, "Provence-Alpes-Côte d'Azur")
 
     
+def parse_map_element(html):
+    position = html.find('id="map-accommodation"')
+    if position != -1:
+        tag_start, tag_end = html.rfind("<", 0, position), html.find(">", position)
+        if tag_start != -1 and tag_end != -1:
+            # A ">" inside an attribute value cuts the tag short, the whole page is parsed then
+            element = BeautifulSoup(html[tag_start:tag_end + 1], features = "html.parser").find(id = "map-accommodation")
+            if element is not None and element.has_attr("data-lat") and element.has_attr("data-lng"): return element
+
+    return BeautifulSoup(html, features = "html.parser", parse_only = SoupStrainer(id = "map-accommodation")).find(id = "map-accommodation")
+
+def parse_tiles(html):
+    soup = BeautifulSoup(html, features = "lxml", parse_only = TILES_STRAINER)
+    return soup.find_all(class_ = "g2f-accommodationTile")
+
 class GitesDeFrance():
 
-    def __init__(self, checkin, checkout, travelers, filters = list(), region = None):
+    def __init__(self, checkin, checkout, travelers, filters = list(), region = None, order = None):
         self.checkin = datetime.strftime(checkin, "%Y-%m-%d") if isinstance(checkin, datetime) else checkin
         self.checkout = datetime.strftime(checkout, "%Y-%m-%d") if isinstance(checkout, datetime) else checkout
         
@@ -49,11 +71,30 @@ class GitesDeFrance():
 
         self.filters = filters if isinstance(filters, list) else [filters]
         self.region = region
+        self.order = order
+        self.order_confirmed = None
+        self.last_price = None
         self.travelers = travelers
         self.seed = None
         self._nb_results = None
         self.results = list()
         self.n = 0
+        self.pages_loaded = 0
+        self._result_ids = set()
+        self._first_page_html = None
+        self._executor, self._page_futures, self._prefetched_until = None, dict(), 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_executor"], state["_page_futures"], state["_prefetched_until"] = None, dict(), 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "pages_loaded" not in state.keys(): self.pages_loaded = ceil(len(self.results) / RESULTS_PER_PAGES)
+        if "order" not in state.keys(): self.order, self.order_confirmed, self.last_price = None, None, None
+        self._result_ids = {result.id for result in self.results}
+        self._executor, self._page_futures, self._prefetched_until = None, dict(), 0
 
     def __iter__(self, n = 0):
         self.n = n - 1
@@ -62,35 +103,84 @@ class GitesDeFrance():
     def __next__(self):
         self.n += 1
         if self.n < self.nb_results:
-            if self.n > len(self.results) - 1:
-                page = (self.n + 1) // RESULTS_PER_PAGES
-                self.results += self.get_result_page(page = page)
+            while self.n > len(self.results) - 1 and self.pages_loaded < self.nb_pages:
+                page_results = self.get_result_page(page = self.pages_loaded)
+                self.check_order(page_results)
+                self.results += page_results
+                self.pages_loaded += 1
+
             try:
                 return self.results[self.n]
             except IndexError:
                 self._nb_results = self.n
+                self.stop_prefetch()
                 raise StopIteration
         else:
+            self.stop_prefetch()
             raise StopIteration
 
     def __len__(self):
         return self.nb_results
 
+    def check_order(self, gites):
+        if self.order is None or self.order_confirmed is False: return
+
+        for gite in gites:
+            if gite.price < 0: continue
+            if self.last_price is not None and (gite.price - self.last_price) * self.order.value < 0:
+                print("Gites are not sorted by price, scanning every result")
+                self.order_confirmed = False
+                return
+            self.last_price = gite.price
+            self.order_confirmed = True
+
+    @property
+    def sorted_by_price(self):
+        return self.order == FilterOrder.ASC and self.order_confirmed is True
+
+    def iter_below_price(self, max_price):
+        for gite in self:
+            if self.sorted_by_price and gite.price >= max_price:
+                self.stop_prefetch()
+                return
+            yield gite
+
     @property
     def result_ids(self):
-        return {result.id for result in self.results}
+        return self._result_ids
+
+    @property
+    def nb_pages(self):
+        return ceil(self.nb_results / RESULTS_PER_PAGES)
 
     @property
     def nb_results(self):
         if self._nb_results is not None: return self._nb_results
 
-        soup = BeautifulSoup(self.get_page_html(page = 0), features = "html.parser")
+        self._first_page_html = self.get_page_html(page = 0)
+        soup = BeautifulSoup(self._first_page_html, features = "lxml", parse_only = RESULTS_COUNT_STRAINER)
         line = [line for line in soup.find_all("p") if "Résultat" in str(line)]
         if len(line) == 0: return 0
         
         self._nb_results = int(re.findall(r"(\d+) Résultats?", str(line[0]))[0])
         return self._nb_results
 
+    def prefetch_pages(self, until = None):
+        self.nb_results # The first page sets the seed used by every other page
+        until = self.nb_pages if until is None else min(until, self.nb_pages)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = get_client().max_workers)
+            self._prefetched_until = max(1, self.pages_loaded)
+
+        for page in range(self._prefetched_until, until):
+            self._page_futures[page] = self._executor.submit(self.get_page_html, page = page)
+        self._prefetched_until = max(self._prefetched_until, until)
+
+    def stop_prefetch(self):
+        if self._executor is None: return
+        self._executor.shutdown(wait = False, cancel_futures = True)
+        self._executor, self._page_futures, self._prefetched_until = None, dict(), 0
+
     def get_page_html(self, page = 0):
         params = {
             "destination": "",
@@ -108,9 +198,14 @@ class GitesDeFrance():
         for i, filter in enumerate(self.filters):
             params["f[{}]".format(i)] = filter.value
 
+        if self.order is not None:
+            # Unverified against a sorted search URL of the site, check_order falls back to a full scan if they are ignored
+            params["sort_by"] = PRICE_SORT_FIELD
+            params["sort_order"] = self.order.name
+
         if self.seed is not None: params["seed"] = self.seed
 
-        req = requests.get(BASE_SEARCH_URL, params = params)
+        req = get_client().get(BASE_SEARCH_URL, params = params)
 
         req.raise_for_status()
         self.last_url = req.url
@@ -122,18 +217,38 @@ class GitesDeFrance():
 
         return req.content
 
+    def fetch_page_html(self, page = 0):
+        if page == 0 and self._first_page_html is not None:
+            html, self._first_page_html = self._first_page_html, None
+            return html
+
+        if page > 0:
+            # Sorted searches may stop early, so only a window of pages is fetched ahead
+            self.prefetch_pages(until = None if self.order is None else page + get_client().max_workers)
+        if page in self._page_futures.keys():
+            return self._page_futures.pop(page).result()
+
+        return self.get_page_html(page = page)
+
     def get_result_page(self, page = 0):
-        soup = BeautifulSoup(self.get_page_html(page = page), features = "html.parser")
-        results = soup.find("section", id = "markup-tiles").select(".g2f-accommodationTile ")
-        output = list()
+        return self.parse_result_page(self.fetch_page_html(page = page))
 
-        for result in results:
-            gite = Gite(result)
-            if gite.id not in self.result_ids:
+    def parse_result_page(self, html):
+        output = list()
+        for result in parse_tiles(html):
+            gite = Gite.from_tile(result)
+            if gite.id not in self._result_ids:
+                self._result_ids.add(gite.id)
                 output.append(gite)
         
         return output
 
+    @staticmethod
+    def prefetch_locations(gites):
+        missing = [gite for gite in gites if gite._location is None]
+        get_client().map(lambda gite: gite.location, missing)
+        return [gite.location for gite in gites]
+
     def to_dict(self):
         output_dict = {
             "checkin": self.checkin,
@@ -143,24 +258,33 @@ class GitesDeFrance():
             "filters": [filter_enum.name for filter_enum in self.filters],
             "n": self.n,
             "nb_results": self._nb_results,
-            "results": [{"soup": result.soup, "location": result._location} for result in self.results]
+            "pages_loaded": self.pages_loaded,
+            "order_confirmed": self.order_confirmed,
+            "last_price": self.last_price,
+            "results": [result.to_dict() for result in self.results]
         }
         if self.region is not None: 
             output_dict["region"] = self.region.name
+        if self.order is not None:
+            output_dict["order"] = self.order.name
         return output_dict
 
     @classmethod
     def from_dict(cls, input_dict):
         region = Regions[input_dict["region"]] if "region" in input_dict.keys() else None
         filters = [Filters[filter_name] for filter_name in input_dict["filters"]]
-        obj = cls(input_dict["checkin"], input_dict["checkout"], input_dict["travelers"], region = region, filters = filters)
+        order = FilterOrder[input_dict["order"]] if "order" in input_dict.keys() else None
+        obj = cls(input_dict["checkin"], input_dict["checkout"], input_dict["travelers"], region = region, filters = filters, order = order)
         obj.seed = input_dict["seed"]
         obj.n = input_dict["n"]
         obj._nb_results = input_dict["nb_results"]
+        obj.order_confirmed = input_dict.get("order_confirmed")
+        obj.last_price = input_dict.get("last_price")
         for result in input_dict["results"]:
-            gite = Gite(BeautifulSoup(result["soup"], features = "html.parser"))
-            gite._location = result["location"]
+            gite = Gite.from_dict(result)
             obj.results.append(gite)
+            obj._result_ids.add(gite.id)
+        obj.pages_loaded = input_dict.get("pages_loaded", ceil(len(obj.results) / RESULTS_PER_PAGES))
         
         return obj
     
@@ -174,45 +298,116 @@ class GitesDeFrance():
             return pickle.load(f)
 
 class Gite():
+    __slots__ = ("link", "id", "images", "title", "epis", "location_name", "bedrooms", "beds", "note", "price", "_location")
 
-    def __init__(self, soup):
-        self.soup = str(soup)
-        self.link = BASE_URL + soup.find_all("a")[2]["href"]
+    def __init__(self, link, images, title, epis, location_name, bedrooms, beds, note, price, location = None):
+        self.link = link
         self.id = re.findall(r"-([a-z0-9]+)(?:\?|$)", self.link)[0]
-        self.images = [BASE_URL + image["data-src"] if "data-src" in image.attrs.keys() else BASE_URL + image["src"] for image in soup.find_all("img")]
-        self.title = soup.find("h2").text.strip()
-        self.epis = len(soup.select(".g2f-levelEpis")[0].find_all("li")) if len(soup.select(".g2f-levelEpis")) > 0 else None
-        self.location_name = soup.select(".g2f-accommodationTile-text-place")[0].text[2:]
-        self.bedrooms, self.beds = re.findall(r"(?:(\d+) chambres)?(?:\s|\\n)*(\d+) personnes", soup.select(".g2f-accommodationTile-text-capacity")[0].text.strip())[0]
-        self.bedrooms, self.beds = int(self.bedrooms) if self.bedrooms != "" else None, int(self.beds)
-        self._location = None
-        self.note = float(soup.select(".g2f-rating-full")[0]["style"][12:16]) if len(soup.select(".g2f-rating-full")) > 0 else None
-
-        price_soup = soup.select(".g2f-accommodationTile-text-price-new")
-        if len(price_soup) > 0:
-            price_soup = price_soup[0]
-            if len(price_soup.find_all("del")) > 0: price_soup = price_soup.find("strong")
-            self.price = int("".join([charac for charac in price_soup.text.strip().split(",")[0] if charac.isdigit()]))
+        self.images = images
+        self.title = title
+        self.epis = epis
+        self.location_name = location_name
+        self.bedrooms, self.beds = bedrooms, beds
+        self.note = note
+        self.price = price
+        self._location = tuple(location) if location is not None else None
+
+    @classmethod
+    def from_tile(cls, soup):
+        links, images, title, by_class = list(), list(), None, dict()
+        for element in soup.find_all(True):
+            if element.name == "a": links.append(element)
+            elif element.name == "img": images.append(element)
+            elif element.name == "h2" and title is None: title = element
+            for class_name in element.get("class", []):
+                by_class.setdefault(class_name, element)
+
+        link = BASE_URL + links[2]["href"]
+        images = [BASE_URL + image["data-src"] if "data-src" in image.attrs.keys() else BASE_URL + image["src"] for image in images]
+        epis = len(by_class["g2f-levelEpis"].find_all("li")) if "g2f-levelEpis" in by_class.keys() else None
+        location_name = by_class["g2f-accommodationTile-text-place"].text[2:]
+        bedrooms, beds = re.findall(r"(?:(\d+) chambres)?(?:\s|\\n)*(\d+) personnes", by_class["g2f-accommodationTile-text-capacity"].text.strip())[0]
+        bedrooms, beds = int(bedrooms) if bedrooms != "" else None, int(beds)
+        note = float(by_class["g2f-rating-full"]["style"][12:16]) if "g2f-rating-full" in by_class.keys() else None
+
+        price_soup = by_class.get("g2f-accommodationTile-text-price-new")
+        if price_soup is not None:
+            if price_soup.find("del") is not None: price_soup = price_soup.find("strong")
+            price = int("".join([charac for charac in price_soup.text.strip().split(",")[0] if charac.isdigit()]))
         else:
-            self.price = -1
+            price = -1
+
+        return cls(link, images, title.text.strip(), epis, location_name, bedrooms, beds, note, price)
+
+    def to_dict(self):
+        output_dict = {key: getattr(self, key) for key in self.__slots__ if key not in ("id", "_location")}
+        output_dict["location"] = self._location
+        return output_dict
+
+    @classmethod
+    def from_dict(cls, input_dict):
+        if "soup" in input_dict.keys():
+            gite = cls.from_tile(BeautifulSoup(input_dict["soup"], features = "lxml"))
+            gite._location = tuple(input_dict["location"]) if input_dict.get("location") is not None else None
+            return gite
+        return cls(**input_dict)
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple): state = state[1]
+        if "soup" in state.keys() and "link" not in state.keys():
+            state = self.from_tile(BeautifulSoup(state["soup"], features = "lxml")).__getstate__()
+        for key in self.__slots__:
+            setattr(self, key, state.get(key))
 
     @property
     def location(self):
         if self._location is not None: return self._location
+
+        cached = get_cache().get("gite_location", {"id": self.id})
+        if cached is not None:
+            self._location = tuple(cached)
+            return self._location
         
-        req = requests.get(self.link)
+        req = get_client().get(self.link)
         req.raise_for_status()
-        soup = BeautifulSoup(req.content, features = "html.parser")
-        map_div = soup.find("div",id="map-accommodation")
+        map_div = parse_map_element(req.content.decode("utf-8", errors = "replace"))
         self._location = float(map_div["data-lat"]), float(map_div["data-lng"])
+        get_cache().set("gite_location", {"id": self.id}, self._location, expire = False)
 
         return self._location
 
     def __str__(self):
         output = str()
-        for key, value in self.__dict__.items():
+        for key, value in self.__getstate__().items():
             if isinstance(value, str) or isinstance(value, int) or isinstance(value, float) and key[0] != "_":
                 if not isinstance(value, str) or len(value) < 100:
                     output += "{}: {} ".format(key, value)
         
-        return output
\ No newline at end of file
+        return output
+
+
+if __name__ == '__main__':
+    import sys, time, tracemalloc
+
+    nb_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    checkin = datetime.now() + timedelta(days = 30)
+    search = GitesDeFrance(checkin, checkin + timedelta(days = 2), 10)
+    search.nb_results
+    search.prefetch_pages()
+    pages = [search.fetch_page_html(page = page) for page in range(min(nb_pages, search.nb_pages))]
+    search.stop_prefetch()
+
+    start = time.perf_counter()
+    gites = [gite for page in pages for gite in search.parse_result_page(page)]
+    elapsed = time.perf_counter() - start
+    print("Parsed {} tiles from {} pages in {:.2f}s ({:.0f} tiles/s)".format(len(gites), len(pages), elapsed, len(gites) / elapsed if elapsed > 0 else 0))
+
+    tracemalloc.start()
+    records = [Gite.from_dict(gite.to_dict()) for gite in gites]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if len(records) > 0:
+        print("{:.0f} bytes in memory and {:.0f} bytes pickled per gite".format(memory / len(records), len(pickle.dumps(records)) / len(records)))
@@ -2,6 +2,7 @@ import gspread, json, time
 import api_car, utils, graphs
 from api_gites import Filters
 from datastores import Participant
+from rate_limiter import QuotaExceededError
 from datetime import datetime
 from math import ceil
 
@@ -58,7 +59,11 @@ class TripPlanningSheet():
             city = city[0]
             if len(cities_cache[i]) > 0 and city == cities_cache[i][0]: continue
             
-            geocode = self.api_open_route.geocode(city)
+            try:
+                geocode = self.api_open_route.geocode(city)
+            except QuotaExceededError as e:
+                print("{}, stopped geocoding at {}".format(e, city))
+                break
             if geocode is None: continue
             cities_cache[i] = set_row(cities_cache[i], geocode["name"])
             cities_coords[i] = set_row(cities_coords[i], json.dumps(geocode["location"]))
@@ -174,7 +179,7 @@ class TripPlanningSheet():
             possibility.number,
             possibility.gite.location_name,
             len(possibility.participants) / possibility.gite.bedrooms if possibility.gite.bedrooms is not None else "?",
-            sum([driver.calculate_detour(possibility.covoit_calculator.matrix) for driver in possibility.covoits.values() if driver.is_driver]) / 86400 / len([driver for driver in possibility.covoits.values() if driver.is_driver]),
+            sum(possibility.covoit_calculator.driver_detours().values()) / 86400 / len([driver for driver in possibility.covoits.values() if driver.is_driver]),
             possibility.total_cost / len(possibility.participants),
             possibility.total_trip_time / 86400 / len(possibility.covoits),
             '=HYPERLINK("#gid={}";"Détails")'.format(possibility.sheet_id) if not possibility.rejected else '=HYPERLINK("{}";"Lien")'.format(possibility.gite.link)
@@ -1,112 +1,205 @@
-import json, csv, os, urllib.request, zipfile
-from utils import distance_km, trace_distance_km, min_distance_km_np
+import json, csv, os, io, zipfile, threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from binary_cache import BinaryCache, csr_from_pairs
+from utils import haversine_km_np, haversine_km_rad, SphericalIndex, download_if_not_exist, read_csv_export
 
-def _download_if_not_exist(url, path):
-    if not os.path.exists(path):
-        print("Downloading {} ...".format(path))
-        urllib.request.urlretrieve(url, path)
-        print("Completed")
+def _connected_stations_csr(arrays):
+    station_uic, stop_uic = arrays["station_uic"], arrays["stop_uic"]
+    stop_ids = np.searchsorted(stop_uic, station_uic).clip(max = max(len(stop_uic) - 1, 0))
+    connected_keys, connected_values = list(), list()
+    for station_id, stop_id in enumerate(stop_ids):
+        if len(stop_uic) == 0 or stop_uic[stop_id] != station_uic[station_id]: continue
+        routes = arrays["stop_routes"][arrays["stop_routes_indptr"][stop_id]:arrays["stop_routes_indptr"][stop_id+1]]
+        stops = np.unique(np.concatenate([arrays["route_stops"][arrays["route_stops_indptr"][route]:arrays["route_stops_indptr"][route+1]] for route in routes]))
+        stops = stops[np.isin(stops, station_uic)]
+        connected_keys.append(np.full(len(stops), station_id, dtype = np.int32))
+        connected_values.append(np.searchsorted(station_uic, stops).astype(np.int32))
+
+    if len(connected_keys) == 0:
+        return np.zeros(len(station_uic) + 1, dtype = np.int64), np.zeros(0, dtype = np.int32)
+    return csr_from_pairs(np.concatenate(connected_keys), np.concatenate(connected_values), len(station_uic))
+
+GTFS_FEEDS = [
+    "https://eu.ftp.opendatasoft.com/sncf/gtfs/export-ter-gtfs-last.zip",
+    "https://eu.ftp.opendatasoft.com/sncf/gtfs/export-intercites-gtfs-last.zip",
+    "https://eu.ftp.opendatasoft.com/sncf/gtfs/export_gtfs_voyages.zip"
+]
+STOP_KEY = 10**10
+
+def _read_gtfs_feed(feed, blacklist, output_path):
+    feed_path = feed.split("/")[-1]
+    download_if_not_exist(feed, feed_path)
+
+    pairs = set()
+    with zipfile.ZipFile(feed_path) as feed_zip:
+        with feed_zip.open("stop_times.txt") as f:
+            csv_reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8-sig"))
+            for row in csv_reader:
+                if row[0] == "trip_id": continue
+
+                if any([blacklist_name in row[-1] for blacklist_name in blacklist]): continue
+
+                pairs.add((row[0].split(":")[0], int(row[3].split("-")[-1])))
+
+    os.remove(feed_path)
+
+    np.save(output_path + "_routes.npy", np.array([route_name for route_name, stop in pairs], dtype = np.str_))
+    np.save(output_path + "_stops.npy", np.array([stop for route_name, stop in pairs], dtype = np.int64))
+    return output_path
 
 class TrainStations():
 
-    def __init__(self):
+    def __init__(self, cache_path = "sncf_cache", rebuild = False):
         self.gtfs_blacklist = [
             "OCENavette"
         ]
 
-        if not os.path.exists("sncf_gares.json"):
-            self._load_stations()
-        else:
-            with open("sncf_gares.json", "r", encoding="utf-8") as f:
-                self.stations = json.load(f)
+        self.cache = BinaryCache(cache_path, sources = ["sncf_gares.json", "sncf_gtfs.json"])
+        if rebuild or not self.cache.is_valid:
+            self._build_cache()
 
-        if not os.path.exists("sncf_gtfs.json"):
-            self._load_gtfs_feeds()
-        else:
-            with open("sncf_gtfs.json", "r", encoding="utf-8") as f:
-                self.gtfs = json.load(f)
+        self._load_cache()
 
-    def _load_stations(self):
-        _download_if_not_exist("https://ressources.data.sncf.com/explore/dataset/referentiel-gares-voyageurs/download/?format=json&timezone=Europe/Berlin&lang=fr", "sncf_gare_names.json")
-        _download_if_not_exist("https://ressources.data.sncf.com/explore/dataset/frequentation-gares/download/?format=json&timezone=Europe/Berlin&lang=fr", "sncf_gares_affluence.json")
+    def _build_cache(self):
+        os.makedirs(self.cache.path, exist_ok = True)
+        with ProcessPoolExecutor(max_workers = len(GTFS_FEEDS)) as executor:
+            if not os.path.exists("sncf_gtfs.json"):
+                gtfs_parts = [executor.submit(_read_gtfs_feed, feed, self.gtfs_blacklist, os.path.join(self.cache.path, "gtfs_part_{}".format(i))) for i, feed in enumerate(GTFS_FEEDS)]
 
-        with open("sncf_gare_names.json", "r", encoding="utf-8") as f:
-            station_data = json.load(f)
+            if os.path.exists("sncf_gares.json"):
+                with open("sncf_gares.json", "r", encoding="utf-8") as f:
+                    stations = json.load(f)
+            else:
+                stations = self._load_stations()
 
-        with open("sncf_gares_affluence.json", "r", encoding="utf-8") as f:
-            affluence_data = json.load(f)
-            affluence_data = {station["fields"]["code_uic_complet"]: station["fields"] for station in affluence_data}
+            if os.path.exists("sncf_gtfs.json"):
+                with open("sncf_gtfs.json", "r", encoding="utf-8") as f:
+                    gtfs = json.load(f)
+                pair_route_names = np.array([route_name for route_name, stop in gtfs], dtype = np.str_)
+                pair_stops = np.array([stop for route_name, stop in gtfs], dtype = np.int64)
+                del gtfs
+            else:
+                pair_route_names, pair_stops = self._merge_gtfs_parts([part.result() for part in gtfs_parts])
 
-        for uic, station in affluence_data.items():
-            affluence_sum, field_count = 0, 0
-            for field_name, field in station.items():
-                if "total_voyageurs_20" in  field_name:
-                    field_count += 1
-                    affluence_sum += field
+        stations = sorted(stations.values(), key = lambda station: int(station["uic_code"]))
+        arrays = {
+            "station_uic": np.array([int(station["uic_code"]) for station in stations], dtype = np.int64),
+            "station_location": np.array([station["location"] for station in stations], dtype = np.float64).reshape(-1, 2),
+            "station_affluence": np.array([station["affluence"] for station in stations], dtype = np.int64),
+            "station_name": np.array([station["name"] for station in stations], dtype = np.str_),
+            "station_city": np.array([station["city"] for station in stations], dtype = np.str_)
+        }
 
-            affluence_data[uic] = int(affluence_sum / field_count)
+        route_names, pair_routes = np.unique(pair_route_names, return_inverse = True)
+        pair_keys = np.unique(pair_routes.astype(np.int64) * STOP_KEY + pair_stops)
+        pair_routes, pair_stops = (pair_keys // STOP_KEY).astype(np.int32), pair_keys % STOP_KEY
+        stop_uic, pair_stop_ids = np.unique(pair_stops, return_inverse = True)
 
-        self.stations = dict()
-        for station in station_data:
-            if not "wgs_84" in station["fields"].keys(): continue
-            uic = int(station["fields"]["uic_code"])
-            gare_dict = {
-                "name": station["fields"]["gare_alias_libelle_noncontraint"],
-                "location": station["fields"]["wgs_84"],
-                "city": station["fields"]["commune_libellemin"],
-                "affluence": affluence_data[uic] if uic in affluence_data.keys() else 0,
-                "uic_code": uic
-            }
-            self.stations[str(gare_dict["uic_code"])] = gare_dict
-
-        with open("sncf_gares.json", "w", encoding="utf-8") as f:
-            json.dump(self.stations, f)
-        
-        os.remove("sncf_gare_names.json")
-        os.remove("sncf_gares_affluence.json")
-
-    def _load_gtfs_feeds(self):
-        gtfs_feeds = [
-            "https://eu.ftp.opendatasoft.com/sncf/gtfs/export-ter-gtfs-last.zip",
-            "https://eu.ftp.opendatasoft.com/sncf/gtfs/export-intercites-gtfs-last.zip",
-            "https://eu.ftp.opendatasoft.com/sncf/gtfs/export_gtfs_voyages.zip"
+        arrays["route_names"] = route_names
+        arrays["stop_uic"] = stop_uic
+        arrays["stop_routes_indptr"], arrays["stop_routes"] = csr_from_pairs(pair_stop_ids, pair_routes, len(stop_uic))
+        arrays["route_stops_indptr"], arrays["route_stops"] = csr_from_pairs(pair_routes, pair_stops, len(route_names))
+        arrays["connected_indptr"], arrays["connected"] = _connected_stations_csr(arrays)
+
+        self.cache.save(arrays)
+
+    def _load_cache(self):
+        arrays, meta = self.cache.load()
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+        self.station_list = [
+            {
+                "name": str(self.station_name[i]),
+                "location": self.station_location[i].tolist(),
+                "city": str(self.station_city[i]),
+                "affluence": int(self.station_affluence[i]),
+                "uic_code": int(self.station_uic[i])
+            } for i in range(len(self.station_uic))
         ]
+        self.stations = {str(station["uic_code"]): station for station in self.station_list}
+        self._spatial_indexes = dict()
+        self._spatial_indexes_lock = threading.Lock()
+
+    def spatial_index(self, min_affluence = None):
+        with self._spatial_indexes_lock:
+            if min_affluence not in self._spatial_indexes.keys():
+                if min_affluence is None:
+                    station_ids = np.arange(len(self.station_uic))
+                else:
+                    station_ids = np.flatnonzero(self.station_affluence > min_affluence)
+                self._spatial_indexes[min_affluence] = (station_ids, SphericalIndex(self.station_location[station_ids]))
+
+            return self._spatial_indexes[min_affluence]
 
-        self.gtfs = list()
-        for feed in gtfs_feeds:
-            feed_path = feed.split("/")[-1]
-            _download_if_not_exist(feed, feed_path)
+    def _station_index(self, uic):
+        i = int(np.searchsorted(self.station_uic, uic))
+        return i if i < len(self.station_uic) and self.station_uic[i] == uic else None
 
-            zipfile.ZipFile(feed_path).extract("stop_times.txt")
-            with open("stop_times.txt", "r") as f:
-                csv_reader = csv.reader(f)
-                for row in csv_reader:
-                    if row[0] == "trip_id": continue
+    def get_stop_routes(self, uic):
+        i = int(np.searchsorted(self.stop_uic, uic))
+        if i == len(self.stop_uic) or self.stop_uic[i] != uic: return []
+        return [str(self.route_names[route_id]) for route_id in self.stop_routes[self.stop_routes_indptr[i]:self.stop_routes_indptr[i+1]]]
 
-                    if any([blacklist in row[-1] for blacklist in self.gtfs_blacklist]): continue
-                    
-                    self.gtfs.append((row[0].split(":")[0], int(row[3].split("-")[-1])))
+    def get_route_stops(self, route_name):
+        route_id = int(np.searchsorted(self.route_names, route_name))
+        if route_id == len(self.route_names) or self.route_names[route_id] != route_name: return []
+        return self.route_stops[self.route_stops_indptr[route_id]:self.route_stops_indptr[route_id+1]].tolist()
 
-            os.remove("stop_times.txt")
-            os.remove(feed_path)
+    def _merge_gtfs_parts(self, part_paths):
+        pair_route_names, pair_stops = list(), list()
+        for part_path in part_paths:
+            pair_route_names.append(np.load(part_path + "_routes.npy"))
+            pair_stops.append(np.load(part_path + "_stops.npy"))
+            os.remove(part_path + "_routes.npy")
+            os.remove(part_path + "_stops.npy")
 
-        with open("sncf_gtfs.json", "w") as f:
-            json.dump(self.gtfs, f)
+        return np.concatenate(pair_route_names), np.concatenate(pair_stops)
+
+    def _load_stations(self):
+        affluence_data = dict()
+        for station in read_csv_export("https://ressources.data.sncf.com/explore/dataset/frequentation-gares/download/?format=csv&use_labels_for_header=false&timezone=Europe/Berlin&lang=fr", "sncf_gares_affluence.csv"):
+            affluences = [int(float(field)) for field_name, field in station.items() if "total_voyageurs_20" in field_name and field not in ("", None)]
+            if len(affluences) > 0:
+                affluence_data[int(station["code_uic_complet"])] = int(sum(affluences) / len(affluences))
+
+        stations = dict()
+        for station in read_csv_export("https://ressources.data.sncf.com/explore/dataset/referentiel-gares-voyageurs/download/?format=csv&use_labels_for_header=false&timezone=Europe/Berlin&lang=fr", "sncf_gare_names.csv"):
+            if station.get("wgs_84") in ("", None): continue
+            uic = int(station["uic_code"])
+            gare_dict = {
+                "name": station["gare_alias_libelle_noncontraint"],
+                "location": [float(coordinate) for coordinate in station["wgs_84"].split(",")],
+                "city": station["commune_libellemin"],
+                "affluence": affluence_data[uic] if uic in affluence_data.keys() else 0,
+                "uic_code": uic
+            }
+            stations[str(gare_dict["uic_code"])] = gare_dict
+
+        os.remove("sncf_gare_names.csv")
+        os.remove("sncf_gares_affluence.csv")
+        return stations
+
+    def find_closest_stations(self, locations, min_affluence = 0, k = 1):
+        station_ids, index = self.spatial_index(min_affluence)
+        distances, indices = index.nearest(locations, k = k)
+        return [[self.station_list[station_ids[i]] for i in row if i >= 0] for row in indices]
 
     def find_closest_station(self, location, min_affluence = 0):
-        lat, lon = location[0], location[1]
-        station_distances = [(station, distance_km([lat, lon], station["location"])) for uic, station in self.stations.items() if station["affluence"] > min_affluence]
-        return min(station_distances, key = lambda x: x[1])[0]
+        return self.find_closest_stations([location], min_affluence = min_affluence)[0][0]
 
-    def get_stations_in_radius(self, location, radius):
-        return [station for station_uic, station in self.stations.items() if distance_km(station["location"], location) < radius]
+    def get_stations_in_radius_many(self, locations, radius, min_affluence = None):
+        station_ids, index = self.spatial_index(min_affluence)
+        return [[self.station_list[station_ids[i]] for i in indices] for indices in index.in_radius(locations, radius)]
 
-    def get_connected_station(self, station):
-        uic = int(station["uic_code"])
-        routes = {route_name for route_name, station in self.gtfs if station == uic}
-        stations = {station for route_name, station in self.gtfs if route_name in routes}
+    def get_stations_in_radius(self, location, radius, min_affluence = None):
+        return self.get_stations_in_radius_many([location], radius, min_affluence = min_affluence)[0]
 
-        return [self.stations[str(uic)] for uic in stations if str(uic) in self.stations.keys()]
+    def get_connected_station(self, station):
+        i = self._station_index(int(station["uic_code"]))
+        if i is None: return []
+        return [self.station_list[j] for j in self.connected[self.connected_indptr[i]:self.connected_indptr[i+1]]]
 
     def get_connected_stations_from_radius(self, location, radius):
         stations = self.get_stations_in_radius(location, radius)
@@ -115,27 +208,65 @@ class TrainStations():
             output += self.get_connected_station(station)
         return output
 
-def get_closest_station_to_segment(from_station, stations, segments, driver_coeff = 6, train_coeff = 2):
-    min_station = (-1, None)
+_train_stations = None
+_train_stations_lock = threading.Lock()
 
+def get_train_stations():
+    global _train_stations
+    with _train_stations_lock:
+        if _train_stations is None:
+            _train_stations = TrainStations()
+        return _train_stations
+
+def get_closest_stations_to_segments(from_stations, stations_list, segments, driver_coeff = 6, train_coeff = 2, chunk_cells = 2**22):
+    route_points = np.radians(np.array([point for segment in segments for point in segment], dtype = np.float64).reshape(-1, 2))
     destination = segments[0][-1]
 
-    for station in stations:
-        station_distance = distance_km(from_station, station["location"])
-        segment_distance = distance_km(station["location"], destination)
+    candidates, owners = list(), list()
+    for i, stations in enumerate(stations_list):
+        seen_uic = set()
+        for station in stations:
+            if station["uic_code"] in seen_uic: continue
+            seen_uic.add(station["uic_code"])
+            candidates.append(station)
+            owners.append(i)
 
-        lat2 = [point[0] for segment in segments for point in segment]
-        lon2 = [point[1] for segment in segments for point in segment]
-        lat1 = [station["location"][0]]*len(lat2)
-        lon1 = [station["location"][1]]*len(lon2)
+    if len(candidates) == 0: return [None] * len(stations_list)
 
-        distances = min_distance_km_np(lat1, lon1, lat2, lon2)
-        min_dist = distances * driver_coeff + station_distance * train_coeff + segment_distance
-        if min_dist < min_station[0] or min_station[0] == -1:
-            min_station = (min_dist, station)
+    owners = np.array(owners)
+    candidate_locations = np.array([station["location"] for station in candidates], dtype = np.float64)
+    candidate_radians = np.radians(candidate_locations)
 
+    segment_distances = np.empty(len(candidates))
+    chunk_size = max(1, chunk_cells // max(1, len(route_points)))
+    for start in range(0, len(candidates), chunk_size):
+        chunk = candidate_radians[start:start + chunk_size]
+        segment_distances[start:start + chunk_size] = haversine_km_rad(chunk[:, 0, None], chunk[:, 1, None], route_points[None, :, 0], route_points[None, :, 1]).min(axis = 1)
 
-    return min_station[1]
+    from_locations = np.array(from_stations, dtype = np.float64).reshape(-1, 2)[owners]
+    station_distances = haversine_km_np(from_locations[:, 0], from_locations[:, 1], candidate_locations[:, 0], candidate_locations[:, 1])
+    destination_distances = haversine_km_np(candidate_locations[:, 0], candidate_locations[:, 1], destination[0], destination[1])
+    scores = segment_distances * driver_coeff + station_distances * train_coeff + destination_distances
+
+    output = list()
+    for i in range(len(stations_list)):
+        owner_ids = np.flatnonzero(owners == i)
+        output.append(candidates[owner_ids[np.argmin(scores[owner_ids])]] if len(owner_ids) > 0 else None)
+
+    return output
+
+def get_closest_station_to_segment(from_station, stations, segments, driver_coeff = 6, train_coeff = 2):
+    return get_closest_stations_to_segments([from_station], [stations], segments, driver_coeff = driver_coeff, train_coeff = train_coeff)[0]
 
 if __name__ == '__main__':
-    TrainStations() #Build cache
\ No newline at end of file
+    import sys, time
+    start_time = time.time()
+    train_stations = TrainStations(rebuild = "--rebuild" in sys.argv) #Build cache
+    print("Loaded {} stations and {} routes in {:.2f}s".format(len(train_stations.station_uic), len(train_stations.route_names), time.time() - start_time))
+    try:
+        import resource
+    except ImportError: # Unix only
+        pass
+    else:
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        print("Peak RSS {:.1f} MB".format(peak_rss / 1024))
\ No newline at end of file
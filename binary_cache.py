@@ -0,0 +1,62 @@
+import json, os
+import numpy as np
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+class BinaryCache():
+
+    def __init__(self, path, sources = list()):
+        self.path = path
+        self.sources = sources
+        self.meta_path = os.path.join(self.path, "meta.json")
+
+    @property
+    def source_fingerprints(self):
+        return {source: file_fingerprint(source) for source in self.sources if os.path.exists(source)}
+
+    @property
+    def is_valid(self):
+        if not os.path.exists(self.meta_path): return False
+
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        stored_fingerprints = meta.get("sources", dict())
+        return all([stored_fingerprints.get(source) == fingerprint for source, fingerprint in self.source_fingerprints.items()])
+
+    def array_path(self, name):
+        return os.path.join(self.path, name + ".npy")
+
+    def save_array(self, name, array):
+        os.makedirs(self.path, exist_ok = True)
+        np.save(self.array_path(name), np.ascontiguousarray(array))
+
+    def save(self, arrays, meta = None):
+        if os.path.exists(self.meta_path): os.remove(self.meta_path)
+
+        for name, array in arrays.items():
+            self.save_array(name, array)
+
+        self.save_meta(list(arrays.keys()), meta)
+
+    def save_meta(self, array_names, meta = None):
+        os.makedirs(self.path, exist_ok = True)
+        meta = dict() if meta is None else dict(meta)
+        meta["arrays"] = array_names
+        meta["sources"] = self.source_fingerprints
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    def load(self):
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        arrays = {name: np.load(self.array_path(name), mmap_mode = "r") for name in meta["arrays"]}
+        return arrays, meta
+
+def csr_from_pairs(keys, values, nb_keys):
+    order = np.lexsort((values, keys))
+    indptr = np.searchsorted(keys[order], np.arange(nb_keys + 1))
+    return indptr, values[order]
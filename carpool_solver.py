@@ -0,0 +1,433 @@
+import os, time, threading, atexit, multiprocessing
+import numpy as np
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+from ortools.constraint_solver import routing_enums_pb2
+from ortools.constraint_solver import pywrapcp
+from utils import distance_matrix_km
+
+EXACT_MAX_PASSENGERS = 10
+EXACT_MAX_DRIVERS = 4
+SPAN_COEFFICIENT = 100
+DECOMPOSE_MIN_NODES = 30
+MAX_COMPUTE_TIME = 10
+CLUSTER_MAX_DRIVERS = 3
+
+_pool, _pool_workers = None, None
+_pool_lock = threading.Lock()
+
+def get_pool(max_workers = None):
+    global _pool, _pool_workers
+    max_workers = os.cpu_count() if max_workers is None else max_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != max_workers:
+            if _pool is not None: _pool.shutdown()
+            # The planner already runs threads when the pool starts, forking it could deadlock the workers
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers = max_workers, mp_context = multiprocessing.get_context(start_method))
+            _pool_workers = max_workers
+        return _pool
+
+@atexit.register
+def shutdown_pool():
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is not None: _pool.shutdown()
+        _pool, _pool_workers = None, None
+
+def is_small_instance(nb_passengers, nb_drivers):
+    return nb_passengers <= EXACT_MAX_PASSENGERS and nb_drivers <= EXACT_MAX_DRIVERS
+
+def route_costs(matrix, start, end, passengers, max_size):
+    # Held-Karp over the passenger subsets a single driver can take
+    paths = {(1 << i, i): (matrix[start][passenger], None) for i, passenger in enumerate(passengers)}
+    for size in range(2, max_size + 1):
+        for combo in combinations(range(len(passengers)), size):
+            mask = sum(1 << i for i in combo)
+            for last in combo:
+                previous_mask = mask ^ (1 << last)
+                paths[(mask, last)] = min(
+                    (paths[(previous_mask, previous)][0] + matrix[passengers[previous]][passengers[last]], previous)
+                    for previous in combo if previous != last
+                )
+
+    costs = {0: (matrix[start][end], None)}
+    for (mask, last), (cost, previous) in paths.items():
+        cost += matrix[passengers[last]][end]
+        if mask not in costs.keys() or cost < costs[mask][0]:
+            costs[mask] = (cost, last)
+
+    def route(mask):
+        order, last = list(), costs[mask][1]
+        while last is not None:
+            order.append(passengers[last])
+            mask, last = mask ^ (1 << last), paths[(mask, last)][1]
+        return order[::-1]
+
+    return {mask: cost for mask, (cost, last) in costs.items()}, route
+
+def greedy_bound(matrix, starts, end, capacities, passengers, costs):
+    masks, lasts = [0] * len(starts), list(starts)
+    for i, passenger in enumerate(passengers):
+        insertions = [
+            (matrix[lasts[vehicle]][passenger] + matrix[passenger][end] - matrix[lasts[vehicle]][end], vehicle)
+            for vehicle in range(len(starts)) if bin(masks[vehicle]).count("1") < capacities[vehicle] - 1
+        ]
+        if len(insertions) == 0: return float("inf")
+        vehicle = min(insertions)[1]
+        masks[vehicle] |= 1 << i
+        lasts[vehicle] = passenger
+
+    route_values = [costs[vehicle][mask] for vehicle, mask in enumerate(masks)]
+    return sum(route_values) + SPAN_COEFFICIENT * max(route_values)
+
+def pareto(front):
+    output, best_max = list(), float("inf")
+    for entry in sorted(front, key = lambda entry: (entry[0], entry[1])):
+        if entry[1] < best_max:
+            output.append(entry)
+            best_max = entry[1]
+    return output
+
+def solve_exact(matrix, starts, end, capacities, passengers):
+    """Minimizes the sum of the routes plus SPAN_COEFFICIENT times the longest one, like the OR-tools model.
+    Capacities count the driver. Returns the ordered passenger nodes of each vehicle, or None when infeasible."""
+    nb_passengers, full_mask = len(passengers), (1 << len(passengers)) - 1
+    if nb_passengers > sum(capacity - 1 for capacity in capacities): return None
+
+    tables = [route_costs(matrix, start, end, passengers, min(capacity - 1, nb_passengers)) for start, capacity in zip(starts, capacities)]
+    costs = [table[0] for table in tables]
+    upper_bound = greedy_bound(matrix, starts, end, capacities, passengers, costs)
+
+    fronts, history = {0: [(0, 0, None)]}, list()
+    for vehicle, capacity in enumerate(capacities):
+        rest = range(vehicle + 1, len(capacities))
+        rest_capacity = sum(capacities[j] - 1 for j in rest)
+        # Every later driver takes some subset, so its cheapest subset bounds its route from below
+        rest_bounds = [min(costs[j].values()) for j in rest]
+        rest_sum, rest_max = sum(rest_bounds), max(rest_bounds, default = 0)
+
+        new_fronts = dict()
+        for mask, front in fronts.items():
+            free = [i for i in range(nb_passengers) if not mask >> i & 1]
+            min_size = max(0, len(free) - rest_capacity)
+            for size in range(min_size, min(len(free), capacity - 1) + 1):
+                for combo in combinations(free, size):
+                    subset = sum(1 << i for i in combo)
+                    cost = costs[vehicle][subset]
+                    for k, (total, longest, back) in enumerate(front):
+                        total, longest = total + cost, max(longest, cost)
+                        if total + rest_sum + SPAN_COEFFICIENT * max(longest, rest_max) > upper_bound: continue
+                        new_fronts.setdefault(mask | subset, list()).append((total, longest, (mask, k, subset)))
+
+        fronts = {mask: pareto(front) for mask, front in new_fronts.items()}
+        history.append(fronts)
+
+    if full_mask not in fronts.keys(): return None
+
+    k = min(range(len(fronts[full_mask])), key = lambda k: fronts[full_mask][k][0] + SPAN_COEFFICIENT * fronts[full_mask][k][1])
+    mask, routes = full_mask, [None] * len(capacities)
+    for vehicle in reversed(range(len(capacities))):
+        total, longest, (previous_mask, previous_k, subset) = history[vehicle][mask][k]
+        routes[vehicle] = tables[vehicle][1](subset)
+        mask, k = previous_mask, previous_k
+
+    return routes
+
+def solve_time_limit(nb_nodes, max_compute_time = None):
+    # Grows with the instance up to about 200 nodes, the stall limit ends converged searches well before it
+    return min(MAX_COMPUTE_TIME if max_compute_time is None else max_compute_time, 0.1 + 0.05 * nb_nodes)
+
+def initial_routes(matrix, starts, end, capacities, previous_routes = None):
+    routes = [list(route) for route in previous_routes] if previous_routes is not None else [list() for _ in starts]
+    placed = {node for route in routes for node in route}
+
+    # Cheapest insertion at the end of a route for every passenger not placed yet
+    for node in range(len(matrix)):
+        if node in placed or node == end or node in starts: continue
+        insertions = [
+            (matrix[route[-1] if len(route) > 0 else start][node] + matrix[node][end] - matrix[route[-1] if len(route) > 0 else start][end], vehicle)
+            for vehicle, (route, start, capacity) in enumerate(zip(routes, starts, capacities)) if len(route) < capacity - 1
+        ]
+        if len(insertions) == 0: return routes
+        routes[min(insertions)[1]].append(node)
+
+    return routes
+
+def solve_ortools(matrix, starts, end, capacities, previous_routes = None, max_compute_time = None, stall_ratio = 0.25):
+    manager = pywrapcp.RoutingIndexManager(len(matrix), len(starts), starts, [end] * len(starts))
+    routing = pywrapcp.RoutingModel(manager)
+
+    transit_callback_index = routing.RegisterTransitMatrix(matrix)
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+
+    cost_dimension_name = "Cost"
+    routing.AddDimension(transit_callback_index, 0, 35*3600, True, cost_dimension_name)
+    cost_dimension = routing.GetDimensionOrDie(cost_dimension_name)
+    cost_dimension.SetGlobalSpanCostCoefficient(SPAN_COEFFICIENT)
+
+    demand_callback_index = routing.RegisterUnaryTransitVector([0 if node == end else 1 for node in range(len(matrix))])
+    routing.AddDimensionWithVehicleCapacity(demand_callback_index, 0, capacities, True, 'Capacity')
+
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = (routing_enums_pb2.FirstSolutionStrategy.GLOBAL_CHEAPEST_ARC)
+    search_parameters.local_search_metaheuristic = (routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
+    time_limit = solve_time_limit(len(matrix), max_compute_time)
+    search_parameters.time_limit.FromMilliseconds(int(time_limit * 1000))
+
+    start = time.perf_counter()
+    routing.CloseModelWithParameters(search_parameters)
+
+    # Stops the search once the best objective has not improved for a fraction of the time budget
+    progress = {"best": None, "last_improvement": start}
+    def on_solution():
+        objective = routing.CostVar().Max()
+        if progress["best"] is None or objective < progress["best"]:
+            progress["best"], progress["last_improvement"] = objective, time.perf_counter()
+    routing.AddAtSolutionCallback(on_solution)
+    stall_time = max(0.05, time_limit * stall_ratio)
+    routing.AddSearchMonitor(routing.solver().CustomLimit(lambda: time.perf_counter() - progress["last_improvement"] > stall_time))
+
+    routes = initial_routes(matrix, starts, end, capacities, previous_routes)
+    initial_solution = routing.ReadAssignmentFromRoutes([[manager.NodeToIndex(node) for node in route] for route in routes], True)
+    if initial_solution is not None:
+        solution = routing.SolveFromAssignmentWithParameters(initial_solution, search_parameters)
+    else:
+        solution = routing.SolveWithParameters(search_parameters)
+    if solution is None: raise LookupError("No solution found {}".format(routing.status()))
+
+    stats = {
+        "solver": "ortools",
+        "nodes": len(matrix),
+        "time_limit": time_limit,
+        "elapsed": time.perf_counter() - start,
+        "objective": solution.ObjectiveValue(),
+        "initial_objective": initial_solution.ObjectiveValue() if initial_solution is not None else None,
+        "warm_start": initial_solution is not None
+    }
+
+    routes = list()
+    for vehicle_id in range(len(starts)):
+        index, route = solution.Value(routing.NextVar(routing.Start(vehicle_id))), list()
+        while not routing.IsEnd(index):
+            route.append(manager.IndexToNode(index))
+            index = solution.Value(routing.NextVar(index))
+        routes.append(route)
+
+    return routes, stats
+
+def solve_single(instance):
+    """Solves one instance as built by CovoitCalculator.solver_instance. Module level so worker processes can run it."""
+    matrix = np.asarray(instance["matrix"]).tolist()
+    starts, end, capacities = list(instance["starts"]), instance["end"], list(instance["capacities"])
+    passengers = [node for node in range(len(matrix)) if node != end and node not in starts]
+
+    if is_small_instance(len(passengers), len(starts)):
+        start = time.perf_counter()
+        routes = solve_exact(matrix, starts, end, capacities, passengers)
+        if routes is not None:
+            return routes, {"solver": "exact", "nodes": len(matrix), "elapsed": time.perf_counter() - start}
+
+    return solve_ortools(matrix, starts, end, capacities, instance.get("previous_routes"), instance.get("max_compute_time"), instance.get("stall_ratio", 0.25))
+
+def is_large_instance(instance):
+    return instance.get("locations") is not None and len(instance["matrix"]) >= DECOMPOSE_MIN_NODES and len(instance["starts"]) > CLUSTER_MAX_DRIVERS
+
+def assign_passengers(locations, starts, end, capacities):
+    # Capacitated assignment by great-circle detour, passengers with the most to lose from a worse driver go first
+    passengers = [node for node in range(len(locations)) if node != end and node not in starts]
+    to_end = distance_matrix_km(locations, [locations[end]])[:, 0]
+    distances = distance_matrix_km([locations[node] for node in passengers], [locations[node] for node in starts])
+    distances += to_end[passengers, None] - to_end[None, starts]
+    sorted_distances = np.sort(distances, axis = 1)
+    regrets = sorted_distances[:, 1] - sorted_distances[:, 0] if len(starts) > 1 else np.zeros(len(passengers))
+
+    seats = [capacity - 1 for capacity in capacities]
+    routes = [list() for _ in starts]
+    for i in np.argsort(-regrets, kind = "stable"):
+        for vehicle in np.argsort(distances[i], kind = "stable"):
+            if seats[vehicle] > 0:
+                seats[vehicle] -= 1
+                routes[vehicle].append(passengers[i])
+                break
+        else:
+            return None
+    return routes
+
+def cluster_drivers(locations, starts, max_drivers = None):
+    max_drivers = CLUSTER_MAX_DRIVERS if max_drivers is None else max_drivers
+    driver_locations = [locations[node] for node in starts]
+    distances = distance_matrix_km(driver_locations, driver_locations)
+
+    clusters, remaining = list(), set(range(len(starts)))
+    while len(remaining) > 0:
+        # Seeds the cluster with the driver farthest from the others left, then adds its closest neighbours
+        seed = max(remaining, key = lambda vehicle: (sum(distances[vehicle][other] for other in remaining), -vehicle))
+        cluster = sorted(remaining, key = lambda vehicle: (distances[seed][vehicle], vehicle))[:max_drivers]
+        clusters.append(cluster)
+        remaining -= set(cluster)
+    return clusters
+
+def decompose(instance):
+    matrix, starts, end, capacities = np.asarray(instance["matrix"]), list(instance["starts"]), instance["end"], list(instance["capacities"])
+    assignment = assign_passengers(instance["locations"], starts, end, capacities)
+    if assignment is None: return None
+
+    parts = list()
+    for vehicles in cluster_drivers(instance["locations"], starts):
+        nodes = [starts[vehicle] for vehicle in vehicles] + [node for vehicle in vehicles for node in assignment[vehicle]] + [end]
+        positions = {node: i for i, node in enumerate(nodes)}
+        sub_instance = dict(instance,
+            matrix = matrix[np.ix_(nodes, nodes)],
+            starts = list(range(len(vehicles))),
+            end = len(nodes) - 1,
+            capacities = [capacities[vehicle] for vehicle in vehicles],
+            previous_routes = [[positions[node] for node in assignment[vehicle]] for vehicle in vehicles],
+            locations = None
+        )
+        parts.append((vehicles, nodes, sub_instance))
+    return parts
+
+def route_cost(matrix, start, route, end):
+    path = [start] + route + [end]
+    return sum(matrix[a][b] for a, b in zip(path[:-1], path[1:]))
+
+def objective(route_values):
+    return sum(route_values) + SPAN_COEFFICIENT * max(route_values)
+
+def repair(matrix, starts, end, capacities, routes, max_rounds = 5):
+    """Relocates single passengers between routes, across cluster boundaries, while the global objective improves."""
+    routes = [list(route) for route in routes]
+    route_values = [route_cost(matrix, start, route, end) for start, route in zip(starts, routes)]
+
+    for _ in range(max_rounds):
+        improved = False
+        for vehicle in range(len(routes)):
+            position = 0
+            while position < len(routes[vehicle]):
+                route = routes[vehicle]
+                node = route[position]
+                previous = starts[vehicle] if position == 0 else route[position - 1]
+                following = end if position == len(route) - 1 else route[position + 1]
+                removal = matrix[previous][following] - matrix[previous][node] - matrix[node][following]
+
+                best, current = None, objective(route_values)
+                for other in range(len(routes)):
+                    if other == vehicle or len(routes[other]) >= capacities[other] - 1: continue
+                    path = [starts[other]] + routes[other] + [end]
+                    for i in range(len(path) - 1):
+                        insertion = matrix[path[i]][node] + matrix[node][path[i + 1]] - matrix[path[i]][path[i + 1]]
+                        values = list(route_values)
+                        values[vehicle] += removal
+                        values[other] += insertion
+                        value = objective(values)
+                        if value < current and (best is None or value < best[0]):
+                            best = (value, other, i, values)
+
+                if best is None:
+                    position += 1
+                    continue
+                value, other, i, route_values = best
+                routes[vehicle].pop(position)
+                routes[other].insert(i, node)
+                improved = True
+
+        improved = swap(matrix, starts, end, routes, route_values) or improved
+        if not improved: break
+
+    # Moved passengers were inserted greedily, each route is reordered at the end, exactly when it is small enough
+    for vehicle, route in enumerate(routes):
+        if len(route) <= EXACT_MAX_PASSENGERS:
+            costs, best_route = route_costs(matrix, starts[vehicle], end, route, len(route))
+            routes[vehicle] = best_route((1 << len(route)) - 1)
+        else:
+            routes[vehicle] = two_opt(matrix, starts[vehicle], end, route)
+
+    return routes
+
+def two_opt(matrix, start, end, route, max_rounds = 20):
+    """Reverses route segments while it shortens the route, for routes too long for route_costs."""
+    path = [start] + list(route) + [end]
+    for _ in range(max_rounds):
+        improved = False
+        for i in range(1, len(path) - 2):
+            for j in range(i + 1, len(path) - 1):
+                # Reversing path[i:j + 1] also reverses the arcs inside it, the matrix is not symmetric
+                before = matrix[path[i - 1]][path[i]] + matrix[path[j]][path[j + 1]] + sum(matrix[path[k]][path[k + 1]] for k in range(i, j))
+                after = matrix[path[i - 1]][path[j]] + matrix[path[i]][path[j + 1]] + sum(matrix[path[k + 1]][path[k]] for k in range(i, j))
+                if after < before:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    improved = True
+        if not improved: break
+    return path[1:-1]
+
+def swap(matrix, starts, end, routes, route_values):
+    """Exchanges two passengers of different routes in place when it improves the global objective."""
+    def replace_delta(vehicle, position, node):
+        route = routes[vehicle]
+        previous = starts[vehicle] if position == 0 else route[position - 1]
+        following = end if position == len(route) - 1 else route[position + 1]
+        return matrix[previous][node] + matrix[node][following] - matrix[previous][route[position]] - matrix[route[position]][following]
+
+    improved = False
+    for vehicle in range(len(routes)):
+        for other in range(vehicle + 1, len(routes)):
+            for i in range(len(routes[vehicle])):
+                for j in range(len(routes[other])):
+                    values = list(route_values)
+                    values[vehicle] += replace_delta(vehicle, i, routes[other][j])
+                    values[other] += replace_delta(other, j, routes[vehicle][i])
+                    if objective(values) < objective(route_values):
+                        routes[vehicle][i], routes[other][j] = routes[other][j], routes[vehicle][i]
+                        route_values[:] = values
+                        improved = True
+    return improved
+
+def solve_batch(instances, max_workers = None):
+    start = time.perf_counter()
+    instances = [dict(instance, matrix = np.asarray(instance["matrix"], dtype = np.int32)) for instance in instances]
+
+    # Large instances are split into clusters that are solved alongside the other instances
+    parts = [decompose(instance) if is_large_instance(instance) else None for instance in instances]
+    jobs = list()
+    for instance, instance_parts in zip(instances, parts):
+        jobs += [sub_instance for vehicles, nodes, sub_instance in instance_parts] if instance_parts is not None else [instance]
+
+    if len(jobs) < 2 or max_workers == 1:
+        results = [solve_single(job) for job in jobs]
+    else:
+        results = list(get_pool(max_workers).map(solve_single, jobs))
+
+    solutions = list()
+    for instance, instance_parts in zip(instances, parts):
+        if instance_parts is None:
+            solutions.append(results.pop(0))
+            continue
+
+        routes = [None] * len(instance["starts"])
+        for vehicles, nodes, sub_instance in instance_parts:
+            sub_routes, sub_stats = results.pop(0)
+            for vehicle, sub_route in zip(vehicles, sub_routes):
+                routes[vehicle] = [nodes[node] for node in sub_route]
+
+        matrix = instance["matrix"].tolist()
+        routes = repair(matrix, list(instance["starts"]), instance["end"], list(instance["capacities"]), routes)
+        solutions.append((routes, {
+            "solver": "clustered",
+            "nodes": len(matrix),
+            "clusters": len(instance_parts),
+            "elapsed": time.perf_counter() - start,
+            "objective": objective([route_cost(matrix, start_node, route, instance["end"]) for start_node, route in zip(instance["starts"], routes)])
+        }))
+
+    return solutions
+
+def solve_instance(instance):
+    return solve_batch([instance], max_workers = 1)[0]
+
+def format_stats(stats):
+    if stats["solver"] == "exact":
+        return "Solved {nodes} nodes exactly in {elapsed:.3f}s".format(**stats)
+    if stats["solver"] == "clustered":
+        return "Solved {nodes} nodes in {clusters} clusters in {elapsed:.3f}s, objective {objective}".format(**stats)
+    return "Solved {nodes} nodes in {elapsed:.3f}s (limit {time_limit:.2f}s), objective {objective} from {initial_objective}".format(**stats)
@@ -1,15 +1,26 @@
-import api_car, api_sncf
+import api_car, api_sncf, carpool_solver, threading
 from datastores import TrainUser
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
+from group_matrix import location_key
+from distance_matrix import DistanceMatrix
+
+def solve_calculators(calculators, executor, max_processes = None, ignore_trains = False):
+    # Matrices may need network calls so instances are built in threads, the solves themselves run in processes
+    instances = list(executor.map(lambda calculator: calculator.solver_instance(ignore_trains = ignore_trains), calculators))
+    solutions = carpool_solver.solve_batch([instance for names_ids, instance in instances], max_workers = max_processes)
+    for calculator, (names_ids, instance), (routes, stats) in zip(calculators, instances, solutions):
+        calculator.apply_solution(names_ids, routes, stats)
 
 class CovoitCalculator():
     
-    def __init__(self, covoits, destination, key = "duration"):
+    def __init__(self, covoits, destination, key = "duration", group_matrix = None, route_cache = None):
         self.covoits = covoits
         self.key = key
-        self._api_sncf = None        
+        self.group_matrix = group_matrix
+        self.route_cache = dict() if route_cache is None else route_cache
         self.last_matrix_destinations, self.last_matrix = None, None
+        self.superset = None
+        self.last_solve_stats = None
+        self._matrix_lock = threading.RLock()
         
         self.api_ors = api_car.OpenRouteService()
         self.api_michelin = api_car.Michelin()
@@ -27,110 +38,109 @@ class CovoitCalculator():
         for covoit_name, covoit in covoits.items():
             covoit.destination = self.destination
     
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("_matrix_lock", None)
+        state.pop("_api_sncf", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.last_matrix, dict): self.last_matrix = DistanceMatrix.from_dict(self.last_matrix)
+        self.__dict__.setdefault("superset", None)
+        self.__dict__.setdefault("route_cache", dict())
+        self.__dict__.setdefault("group_matrix", None)
+        self.__dict__.setdefault("last_solve_stats", None)
+        self._matrix_lock = threading.RLock()
+
     @property
     def matrix(self):
-        if self.last_matrix_destinations != self.destinations:
-            self.last_matrix = self.api_ors.matrix(self.destinations)
-            self.last_matrix_destinations = dict(self.destinations)
-            
-        return self.last_matrix
+        with self._matrix_lock:
+            if self.last_matrix_destinations != self.destinations:
+                self.last_matrix = self.get_matrix(self.destinations)
+                self.last_matrix_destinations = dict(self.destinations)
+                
+            return self.last_matrix
+
+    def get_matrix(self, destinations):
+        # Every matrix is sliced from the largest one fetched so far, keyed by location
+        keys = [location_key(location) for location in destinations.values()]
+        unique = {key: name for name, key in reversed(list(zip(destinations.keys(), keys)))}
+
+        with self._matrix_lock:
+            if self.superset is None:
+                if self.group_matrix is not None and self.group_matrix.can_serve(destinations):
+                    self.superset = self.group_matrix.get_matrix(destinations).take(list(unique.values())).renamed(list(unique.keys()))
+                else:
+                    self.superset = self.api_ors.matrix({key: destinations[name] for key, name in unique.items()})
+
+            missing = [key for key in unique.keys() if key not in self.superset]
+            if len(missing) > 0:
+                known = [list(key) for key in self.superset.names]
+                rows = self.api_ors.matrix_block([list(key) for key in missing], known + [list(key) for key in missing])
+                columns = self.api_ors.matrix_block(known, [list(key) for key in missing])
+                self.superset = self.superset.extended(missing, rows, columns)
+
+            return self.superset.take(keys).renamed(list(destinations.keys()))
 
     def crop_last_matrix(self, remove_names):
         if self.last_matrix is None: self.matrix
 
         self.set_destinations({covoit_name: covoit for covoit_name, covoit in self.covoits.items() if not covoit_name in remove_names})
-
-        for key_row, row in list(self.last_matrix.items()):
-            if key_row in remove_names:
-                self.last_matrix.pop(key_row)
-            else:
-                for key_column, column in list(row.items()):
-                    if key_column in remove_names:
-                        self.last_matrix[key_row].pop(key_column)
-        
+        self.last_matrix = self.last_matrix.crop(remove_names)
         self.last_matrix_destinations = self.destinations
 
-    def get_solution(self, ignore_trains = False, max_compute_time = 1):
+    def solver_instance(self, ignore_trains = False, max_compute_time = None, stall_ratio = 0.25):
         if not ignore_trains:
             self.set_destinations(self.covoits)
         else:
             self.set_destinations({covoit_name: covoit for covoit_name, covoit in self.covoits.items() if not isinstance(covoit, TrainUser)})
         
-        names_ids, ids_names, matrix_for_ortools = self.get_matrix_from_key()
-        data = {
-            "distance_matrix": matrix_for_ortools,
-            "num_vehicles":len(self.drivers),
-            "starts": [ids_names[driver_name] for driver_name, driver in self.drivers.items()],
-            "ends": [ids_names["_end"] for _ in range(len(self.drivers))],
-            "vehicle_capacities": [driver.capacity for driver_name, driver in self.drivers.items()],
-            "demands": [1 if i < len(self.matrix)-1 else 0 for i in range(len(self.matrix))]
+        names_ids, ids_names, matrix = self.get_matrix_from_key()
+        previous_routes = list()
+        for driver in self.drivers.values():
+            # Only the passengers still in the model are kept to warm start the solver
+            route = [ids_names[passenger_name] for passenger_name in driver.passenger_names if passenger_name in ids_names.keys()]
+            previous_routes.append(route[:driver.capacity - 1])
+
+        instance = {
+            "matrix": matrix,
+            "starts": [ids_names[driver_name] for driver_name in self.drivers.keys()],
+            "end": ids_names["_end"],
+            "capacities": [driver.capacity for driver in self.drivers.values()],
+            "previous_routes": previous_routes,
+            "locations": [self.destinations[names_ids[node]] for node in range(len(names_ids))],
+            "max_compute_time": max_compute_time,
+            "stall_ratio": stall_ratio
         }
-        manager = pywrapcp.RoutingIndexManager(len(data['distance_matrix']), data['num_vehicles'], data['starts'], data['ends'])
-        routing = pywrapcp.RoutingModel(manager)
-
-        def distance_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            return data['distance_matrix'][from_node][to_node]
-            
-        transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-        routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-
-        cost_dimension_name = "Cost"
-        routing.AddDimension(transit_callback_index, 0, 35*3600, True, cost_dimension_name)
-        cost_dimension = routing.GetDimensionOrDie(cost_dimension_name)
-        cost_dimension.SetGlobalSpanCostCoefficient(100)
-
-        def demand_callback(from_index):
-            from_node = manager.IndexToNode(from_index)
-            return data['demands'][from_node]
-        
-        demand_callback_index = routing.RegisterUnaryTransitCallback(demand_callback)
-        routing.AddDimensionWithVehicleCapacity(demand_callback_index, 0, data['vehicle_capacities'], True, 'Capacity')
-
-        search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-        search_parameters.first_solution_strategy = (routing_enums_pb2.FirstSolutionStrategy.GLOBAL_CHEAPEST_ARC)
-        search_parameters.local_search_metaheuristic = (routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-        search_parameters.time_limit.seconds = max_compute_time
-
-        solution = routing.SolveWithParameters(search_parameters)
-        if solution is None: raise LookupError("No solution found {}".format(routing.status()))
-        for vehicle_id in range(data['num_vehicles']):
-            index = routing.Start(vehicle_id)
-            driver = self.covoits[names_ids[manager.IndexToNode(index)]]
-            driver.passenger_names = list()
-            while not routing.IsEnd(index):
-                index = solution.Value(routing.NextVar(index))
-                if names_ids[manager.IndexToNode(index)] == "_end":
-                    break
-                driver.passenger_names.append(names_ids[manager.IndexToNode(index)])
-            
+        return names_ids, instance
+
+    def apply_solution(self, names_ids, routes, stats):
+        self.last_solve_stats = stats
+        print(carpool_solver.format_stats(stats))
+        for driver_name, route in zip(self.drivers.keys(), routes):
+            self.covoits[driver_name].passenger_names = [names_ids[node] for node in route]
+
         return self.covoits
+
+    def get_solution(self, ignore_trains = False, max_compute_time = None, stall_ratio = 0.25):
+        names_ids, instance = self.solver_instance(ignore_trains, max_compute_time, stall_ratio)
+        routes, stats = carpool_solver.solve_instance(instance)
+        return self.apply_solution(names_ids, routes, stats)
     
     @property
     def api_sncf(self):
-        if self._api_sncf is None:
-            self._api_sncf = api_sncf.TrainStations()
-        return self._api_sncf
+        return api_sncf.get_train_stations()
 
     def get_matrix_from_key(self):
         source = self.matrix
-        name_list = list(source.keys())
+        name_list = source.keys()
         name_list += [name_list.pop(name_list.index("_end"))]
         
         names_ids = {i: name for i, name in enumerate(name_list)}
         ids_names = {name: i for i, name in enumerate(name_list)}
         
-        matrix = [[list() for i in names_ids.keys()] for i in names_ids.keys()]
-        
-        for i in range(len(matrix)):
-            for j in range(len(matrix[i])):
-                if i == j:
-                    matrix[i][j] = 0
-                else:
-                    matrix[i][j] = int(source[names_ids[i]][names_ids[j]][self.key])
-        
-        return names_ids, ids_names, matrix
+        return names_ids, ids_names, source.solver_matrix(name_list, key = self.key)
 
     def set_train_stations(self):
         if not any([isinstance(covoit, TrainUser) for covoit in self.covoits.values()]):
@@ -143,21 +153,35 @@ class CovoitCalculator():
 
         train_users = {covoit_name: covoit for covoit_name, covoit in self.covoits.items() if isinstance(covoit, TrainUser)}
 
-        for train_user_name, train_user in train_users.items():
-            stations = self.api_sncf.get_connected_stations_from_radius(train_user.departure_location, train_user.station_radius)
-            train_user.train_station = api_sncf.get_closest_station_to_segment(train_user.departure_location, stations, segments)
+        stations_list = [self.api_sncf.get_connected_stations_from_radius(train_user.departure_location, train_user.station_radius) for train_user in train_users.values()]
+        closest_stations = api_sncf.get_closest_stations_to_segments([train_user.departure_location for train_user in train_users.values()], stations_list, segments)
+        for train_user, train_station in zip(train_users.values(), closest_stations):
+            train_user.train_station = train_station
 
         return self.covoits
 
     def set_routes(self):
-        for driver in self.drivers.values():
-            self.api_ors.set_driver_route(driver, self.covoits)
-        
+        route_keys = {name: tuple(location_key(waypoint) for waypoint in driver.waypoints(self.covoits)) for name, driver in self.drivers.items()}
+        missing = [name for name, driver in self.drivers.items() if route_keys[name] not in self.route_cache.keys()]
+
+        for name in missing:
+            self.api_ors.set_driver_route(self.drivers[name], self.covoits)
+        directions = self.api_michelin.directions_multithreaded([self.drivers[name].waypoints(self.covoits) for name in missing])
+        for name, direction in zip(missing, directions):
+            self.route_cache[route_keys[name]] = {"route": self.drivers[name].route, "total_cost": direction["total_cost"]}
+
+        for name, driver in self.drivers.items():
+            driver.route = self.route_cache[route_keys[name]]["route"]
+
         self.set_trip_times()
 
-        directions = self.api_michelin.directions_multithreaded([driver.waypoints(self.covoits) for driver in self.drivers.values()])
-        for i, driver in enumerate(self.drivers.values()):
-            driver.set_trip_costs(self.matrix, self.covoits, directions[i]["total_cost"])
+        for name, driver in self.drivers.items():
+            driver.set_trip_costs(self.matrix, self.covoits, self.route_cache[route_keys[name]]["total_cost"])
+
+    def driver_detours(self, key = "duration"):
+        routes = [(name, driver.passenger_names) for name, driver in self.drivers.items()]
+        detours = self.matrix.trips(routes, key = key) - self.matrix.trips([(name, []) for name, passengers in routes], key = key)
+        return dict(zip(self.drivers.keys(), detours.tolist()))
 
     def set_trip_times(self):
         for driver in self.drivers.values():
@@ -29,19 +29,9 @@ class Covoit():
         return waypoints
         
     def calculate_trip(self, matrix, passengers = None, key = "duration", start_step = None):
-        trip_sum = 0
-        
         if passengers is None and self.is_driver: passengers = self.passenger_names
         
-        previous_step = self.name if start_step is None else start_step
-        for passenger in passengers:
-            trip_sum += matrix[previous_step][passenger][key]
-            previous_step = passenger
-            
-        if "_end" in matrix.keys():
-            trip_sum += matrix[previous_step]["_end"][key]
-            
-        return trip_sum
+        return matrix.trip(self.name if start_step is None else start_step, passengers, key = key)
 
     def calculate_detour(self, matrix, passenger_name = None, key = "duration" , absolute = False):
         if not self.is_driver: return None
@@ -52,19 +42,16 @@ class Covoit():
             if absolute:
                 return self.calculate_trip(matrix, passengers = [passenger_name], key = key) - self.calculate_trip(matrix, passengers = [])
             else:
-                temp_passengers = list(self.passenger_names)
-                temp_passengers.remove(passenger_name)
-                
-                return self.calculate_trip(matrix, key = key) - self.calculate_trip(matrix, passengers = temp_passengers)
+                return float(matrix.removal_detours(self.name, self.passenger_names, key = key)[self.passenger_names.index(passenger_name)])
 
     def set_trip_times(self, matrix, covoits):
         if not self.is_driver: return None
         
         self.trip_time = self.calculate_trip(matrix)
 
-        for i, passenger_name in enumerate(self.passenger_names):
+        for passenger_name, trip_time in zip(self.passenger_names, matrix.remaining_trips(self.name, self.passenger_names)):
             passenger = covoits[passenger_name]
-            passenger.trip_time = self.calculate_trip(matrix, self.passenger_names[i:], start_step = passenger_name)
+            passenger.trip_time = float(trip_time)
             if isinstance(passenger, TrainUser):
                 passenger.trip_time += (distance_km(passenger.departure_location, passenger.location) / vitesse_train) * 3600
 
@@ -73,12 +60,12 @@ class Covoit():
         
         total_cost *= 2 # Multiplies by two to account for return trip
 
-        total_distance = sum([matrix[passenger_name]["_end"]["distance"] for passenger_name in self.passenger_names])
-        total_distance += matrix[self.name]["_end"]["distance"]
+        distances = matrix.to_end([self.name] + self.passenger_names, key = "distance")
+        trip_costs = distances / distances.sum() * total_cost
         
-        self.trip_cost = (matrix[self.name]["_end"]["distance"] / total_distance) * total_cost
-        for passenger_name in self.passenger_names:
-                covoits[passenger_name].trip_cost = (matrix[passenger_name]["_end"]["distance"] / total_distance) * total_cost
+        self.trip_cost = float(trip_costs[0])
+        for passenger_name, trip_cost in zip(self.passenger_names, trip_costs[1:]):
+            covoits[passenger_name].trip_cost = float(trip_cost)
 
     def __str__(self):
         output = str()
@@ -0,0 +1,108 @@
+import numpy as np
+
+class DistanceMatrix():
+
+    def __init__(self, names, durations, distances):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.durations = np.ascontiguousarray(durations, dtype = np.float64).reshape(len(self.names), len(self.names))
+        self.distances = np.ascontiguousarray(distances, dtype = np.float64).reshape(len(self.names), len(self.names))
+
+    @classmethod
+    def from_dict(cls, matrix):
+        names = list(matrix.keys())
+        return cls(
+            names,
+            [[matrix[source][destination]["duration"] for destination in names] for source in names],
+            [[matrix[source][destination]["distance"] for destination in names] for source in names]
+        )
+
+    def to_dict(self):
+        return {
+            source: {
+                destination: {"duration": float(self.durations[i, j]), "distance": float(self.distances[i, j])}
+                for j, destination in enumerate(self.names)
+            } for i, source in enumerate(self.names)
+        }
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index.keys()
+
+    def keys(self):
+        return list(self.names)
+
+    def array(self, key = "duration"):
+        return self.durations if key == "duration" else self.distances
+
+    def indices(self, names):
+        return np.array([self.index[name] for name in names], dtype = np.intp)
+
+    def value(self, source, destination, key = "duration"):
+        return float(self.array(key)[self.index[source], self.index[destination]])
+
+    def take(self, names):
+        indices = self.indices(names)
+        selection = np.ix_(indices, indices)
+        return DistanceMatrix(names, self.durations[selection], self.distances[selection])
+
+    def renamed(self, names):
+        return DistanceMatrix(names, self.durations, self.distances)
+
+    def extended(self, names, rows, columns):
+        # rows holds the trips from the new names to every name, columns the trips from the existing names to the new ones
+        size = len(self.names) + len(names)
+        arrays = list()
+        for array, key in [(self.durations, "durations"), (self.distances, "distances")]:
+            output = np.empty((size, size))
+            output[:len(self.names), :len(self.names)] = array
+            output[:len(self.names), len(self.names):] = np.asarray(columns[key], dtype = np.float64).reshape(len(self.names), len(names))
+            output[len(self.names):, :] = np.asarray(rows[key], dtype = np.float64).reshape(len(names), size)
+            arrays.append(output)
+        return DistanceMatrix(self.names + list(names), *arrays)
+
+    def crop(self, remove_names):
+        remove_names = set(remove_names)
+        return self.take([name for name in self.names if name not in remove_names])
+
+    def path(self, start, stops = None):
+        return self.indices([start] + list(stops if stops is not None else []) + (["_end"] if "_end" in self else []))
+
+    def legs(self, start, stops = None, key = "duration"):
+        path = self.path(start, stops)
+        return self.array(key)[path[:-1], path[1:]]
+
+    def trip(self, start, stops = None, key = "duration"):
+        return float(self.legs(start, stops, key).sum())
+
+    def trips(self, routes, key = "duration"):
+        paths = [self.path(start, stops) for start, stops in routes]
+        if len(paths) == 0: return np.zeros(0)
+
+        sources = np.concatenate([path[:-1] for path in paths])
+        destinations = np.concatenate([path[1:] for path in paths])
+        offsets = np.cumsum([0] + [len(path) - 1 for path in paths[:-1]])
+        legs = np.append(self.array(key)[sources, destinations], 0)
+        return np.where([len(path) > 1 for path in paths], np.add.reduceat(legs, offsets), 0)
+
+    def remaining_trips(self, start, stops, key = "duration"):
+        # Trip from each stop to the end of the route
+        return np.append(np.cumsum(self.legs(start, stops, key)[::-1])[::-1], 0)[1:len(stops) + 1]
+
+    def removal_detours(self, start, stops, key = "duration"):
+        if "_end" not in self:
+            return np.array([self.trip(start, stops, key) - self.trip(start, [stop for stop in stops if stop != removed], key) for removed in stops])
+
+        path, array = self.path(start, stops), self.array(key)
+        return array[path[:-2], path[1:-1]] + array[path[1:-1], path[2:]] - array[path[:-2], path[2:]]
+
+    def to_end(self, names, key = "duration"):
+        return self.array(key)[self.indices(names), self.index["_end"]]
+
+    def solver_matrix(self, names, key = "duration"):
+        indices = self.indices(names)
+        output = self.array(key)[np.ix_(indices, indices)].astype(np.int64)
+        np.fill_diagonal(output, 0)
+        return output
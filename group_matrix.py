@@ -0,0 +1,116 @@
+import api_car, threading
+from distance_matrix import DistanceMatrix
+
+def location_key(location):
+    return tuple(round(coordinate, 6) for coordinate in location)
+
+class GroupMatrix():
+
+    def __init__(self, api_ors = None):
+        self.api_ors = api_car.OpenRouteService() if api_ors is None else api_ors
+        self.locations = dict()
+        self.block = dict()
+        self.gite_columns = dict()
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def set_participants(self, participants):
+        with self._lock:
+            locations = {participant.name: participant.location for participant in participants if participant.location is not None}
+            changed = [name for name, location in locations.items() if name not in self.locations.keys() or location_key(location) != location_key(self.locations[name])]
+            removed = [name for name in self.locations.keys() if name not in locations.keys() or name in changed]
+            if len(changed) == 0 and len(removed) == 0: return
+
+            for name in removed:
+                self.block.pop(name, None)
+                for row in self.block.values(): row.pop(name, None)
+                for column in self.gite_columns.values(): column.pop(name, None)
+
+            self.locations = locations
+            if len(changed) == 0: return
+            self.patch_block(changed)
+            self.patch_gite_columns(changed)
+
+    def patch_block(self, changed):
+        names = list(self.locations.keys())
+        unchanged = [name for name in names if name not in changed]
+        changed_locations = [self.locations[name] for name in changed]
+
+        rows = self.api_ors.matrix_block(changed_locations, list(self.locations.values()))
+        for i, name_source in enumerate(changed):
+            self.block[name_source] = {
+                name_dest: {"distance": rows["distances"][i][j], "duration": rows["durations"][i][j]}
+                for j, name_dest in enumerate(names)
+            }
+
+        if len(unchanged) == 0: return
+        columns = self.api_ors.matrix_block([self.locations[name] for name in unchanged], changed_locations)
+        for i, name_source in enumerate(unchanged):
+            for j, name_dest in enumerate(changed):
+                self.block[name_source][name_dest] = {"distance": columns["distances"][i][j], "duration": columns["durations"][i][j]}
+
+    def patch_gite_columns(self, changed):
+        if len(self.gite_columns) == 0: return
+
+        gite_keys = list(self.gite_columns.keys())
+        raw_data = self.api_ors.matrix_block([self.locations[name] for name in changed], [list(key) for key in gite_keys])
+        for i, name in enumerate(changed):
+            for j, key in enumerate(gite_keys):
+                self.gite_columns[key][name] = {"distance": raw_data["distances"][i][j], "duration": raw_data["durations"][i][j]}
+
+    def missing_gites(self, gite_locations):
+        missing = {location_key(location): list(location) for location in gite_locations if location_key(location) not in self.gite_columns.keys()}
+        return list(missing.values())
+
+    def prefetch_requests(self, gite_locations):
+        with self._lock:
+            return self.api_ors.matrix_requests(list(self.locations.values()), self.missing_gites(gite_locations))
+
+    def prefetch(self, gite_locations):
+        with self._lock:
+            missing = self.missing_gites(gite_locations)
+
+            if len(missing) == 0 or len(self.locations) == 0: return
+
+            names = list(self.locations.keys())
+            raw_data = self.api_ors.matrix_block(list(self.locations.values()), missing)
+            for j, location in enumerate(missing):
+                self.gite_columns[location_key(location)] = {
+                    name: {"distance": raw_data["distances"][i][j], "duration": raw_data["durations"][i][j]}
+                    for i, name in enumerate(names)
+                }
+
+    def can_serve(self, destinations):
+        with self._lock:
+            return all([name == "_end" or (name in self.locations.keys() and location_key(location) == location_key(self.locations[name])) for name, location in destinations.items()])
+
+    def get_matrix(self, destinations):
+        with self._lock:
+            end_location = destinations["_end"]
+            self.prefetch([end_location])
+            end_column = self.gite_columns[location_key(end_location)]
+
+            def trip(name_source, name_dest):
+                if name_source == "_end" and name_dest == "_end":
+                    return {"distance": 0, "duration": 0}
+                elif name_dest == "_end":
+                    return end_column[name_source]
+                elif name_source == "_end":
+                    return end_column[name_dest] # The vehicle end node is never left, the reverse trip is used as an estimate
+                return self.block[name_source][name_dest]
+
+            names = list(destinations.keys())
+            trips = [[trip(name_source, name_dest) for name_dest in names] for name_source in names]
+            return DistanceMatrix(
+                names,
+                [[trip_dict["duration"] for trip_dict in row] for row in trips],
+                [[trip_dict["distance"] for trip_dict in row] for row in trips]
+            )
@@ -0,0 +1,77 @@
+import requests, random, time, threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+class HttpClient():
+
+    def __init__(self, max_workers = 8, connections_per_host = 8, timeout = (5, 60), retries = 5, backoff = 0.5, max_backoff = 30):
+        self.max_workers = max_workers
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._hosts = dict()
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts.keys():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = self.connections_per_host)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._hosts[host] = (session, threading.BoundedSemaphore(self.connections_per_host))
+            return self._hosts[host]
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def request(self, method, url, retry_status_codes = RETRY_STATUS_CODES, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        session, semaphore = self._host(url)
+
+        for attempt in range(self.retries + 1):
+            try:
+                with semaphore:
+                    response = session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.retries: raise
+            else:
+                if response.status_code not in retry_status_codes or attempt == self.retries:
+                    return response
+
+            time.sleep(self.backoff_delay(attempt))
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def download(self, url, path, chunk_size = 2**20):
+        response = self.get(url, stream = True)
+        response.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size = chunk_size):
+                f.write(chunk)
+        return path
+
+    def map(self, function, iterable):
+        items = list(iterable)
+        if len(items) == 0: return []
+
+        with ThreadPoolExecutor(max_workers = min(self.max_workers, len(items))) as executor:
+            return list(executor.map(function, items))
+
+_client = None
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = HttpClient()
+    return _client
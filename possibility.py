@@ -1,86 +1,136 @@
-from covoit_calculator import CovoitCalculator
+from covoit_calculator import CovoitCalculator, solve_calculators
+from datastores import TrainUser
 from api_car import InvalidLocationError
+from group_matrix import location_key
+import threading
 
 class Possibility():
-    def __init__(self, participants, gite, with_trains = True):
+    def __init__(self, participants, gite, with_trains = True, group_matrix = None):
         self.participants = participants
         self.gite = gite
+        self.group_matrix = group_matrix
         self._covoits, self._covoit_calculator = None, None
         self._solution_set = False
         self._route_set = False
+        self.route_cache = dict()
         self.invalid = False
         
         self.rejected = False
         self.sheet_id = None
         self.number = 0
         self.with_trains = with_trains
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("route_cache", dict())
+        self.__dict__.setdefault("group_matrix", None)
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def routing_fields(participants):
+        return sorted((participant.name, participant.is_driver, participant.capacity, participant.location and location_key(participant.location)) for participant in participants)
 
     def set_participants(self, participants):
-        if not sorted(participants, key=lambda x: x.name) == sorted(self.participants, key=lambda x: x.name):
+        with self._lock:
+            changed = self.routing_fields(participants) != self.routing_fields(self.participants)
             self.participants = participants
-            self._covoits, self._covoit_calculator = None, None
-            self._solution_set = False
-            self._route_set = False
-            self.sheet_id = None
+            if changed:
+                # The group matrix only refetches the changed rows and unchanged driver routes stay in route_cache
+                self._covoits, self._covoit_calculator = None, None
+                self._solution_set = False
+                self._route_set = False
+                self.sheet_id = None
 
     @property
     def covoits(self):
-        if self._covoits is None:
-            self._covoits = {participant.name: participant.get_covoit(self.gite.location) for participant in self.participants}
-        return self._covoits
+        with self._lock:
+            if self._covoits is None:
+                self._covoits = {participant.name: participant.get_covoit(self.gite.location) for participant in self.participants}
+            return self._covoits
 
     @property
     def covoit_calculator(self):
-        if self._covoit_calculator is None:
-            self._covoit_calculator = CovoitCalculator(self.covoits, self.gite.location)
-        return self._covoit_calculator
+        with self._lock:
+            if self._covoit_calculator is None:
+                self._covoit_calculator = CovoitCalculator(self.covoits, self.gite.location, group_matrix = self.group_matrix, route_cache = self.route_cache)
+            return self._covoit_calculator
 
     def set_solution(self):
-        if not self._solution_set:
-            if self.with_trains:
+        with self._lock:
+            if not self._solution_set:
+                if self.with_trains:
+                    self.covoit_calculator.get_solution()
+                    self.covoit_calculator.convert_fartest_passengers_to_trains()
                 self.covoit_calculator.get_solution()
-                self.covoit_calculator.convert_fartest_passengers_to_trains()
-            self.covoit_calculator.get_solution()
-            self._solution_set = True
+                self._solution_set = True
+
+    @staticmethod
+    def set_solutions(possibilities, executor, max_processes = None):
+        pending = [possibility for possibility in possibilities if not possibility._solution_set]
+        with_trains = [possibility for possibility in pending if possibility.with_trains]
+
+        solve_calculators([possibility.covoit_calculator for possibility in with_trains], executor, max_processes)
+        list(executor.map(lambda possibility: possibility.covoit_calculator.convert_fartest_passengers_to_trains(), with_trains))
+
+        # Without any train user the second solve would see the same instance
+        resolve = [possibility for possibility in pending if not possibility.with_trains or any([isinstance(covoit, TrainUser) for covoit in possibility.covoits.values()])]
+        solve_calculators([possibility.covoit_calculator for possibility in resolve], executor, max_processes)
+        for possibility in pending:
+            possibility._solution_set = True
+
+    def reset_solution(self):
+        with self._lock:
+            self._covoits = None
+            self._covoit_calculator = None
+            self._solution_set = False
 
     def refresh_solution(self):
-        self._covoits = None
-        self._covoit_calculator = None
-        self._solution_set = False
-        self.set_solution()
+        with self._lock:
+            self.reset_solution()
+            self.set_solution()
 
     def set_routes(self):
-        if not self._route_set:
-            try:
-                self.set_solution()
-                self.covoit_calculator.set_routes()
-            except InvalidLocationError as e:
-                self.invalid = True
-                self.rejected = True
-                raise e
-            else:
-                self._route_set = True
+        with self._lock:
+            if not self._route_set:
+                try:
+                    self.set_solution()
+                    self.covoit_calculator.set_routes()
+                except InvalidLocationError as e:
+                    self.invalid = True
+                    self.rejected = True
+                    raise e
+                else:
+                    self._route_set = True
 
     def refresh_routes(self):
-        self._route_set = False
-        self.set_routes()
+        with self._lock:
+            self._route_set = False
+            self.set_routes()
 
     @property
     def total_trip_time(self):
-        total_trip_time = 0
-        self.set_solution()
-        self.covoit_calculator.set_trip_times()
-        for covoit in self.covoits.values():
-            total_trip_time += covoit.trip_time
-        return total_trip_time
+        with self._lock:
+            total_trip_time = 0
+            self.set_solution()
+            self.covoit_calculator.set_trip_times()
+            for covoit in self.covoits.values():
+                total_trip_time += covoit.trip_time
+            return total_trip_time
 
     @property    
     def total_trip_cost(self):
-        total_trip_cost = 0
-        self.set_routes()
-        for covoit in self.covoits.values():
-            total_trip_cost += covoit.trip_cost
-        return total_trip_cost
+        with self._lock:
+            total_trip_cost = 0
+            self.set_routes()
+            for covoit in self.covoits.values():
+                total_trip_cost += covoit.trip_cost
+            return total_trip_cost
 
     @property
     def total_cost(self):
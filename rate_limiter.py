@@ -0,0 +1,119 @@
+import json, os, time, threading
+from datetime import date
+
+DEFAULT_LIMITS = {
+    "ors_matrix": {"per_minute": 40, "per_day": 500},
+    "ors_directions": {"per_minute": 40, "per_day": 2000},
+    "ors_geocode": {"per_minute": 100, "per_day": 1000},
+    "michelin": {"per_minute": 60, "per_day": None}
+}
+
+class QuotaExceededError(Exception):
+    pass
+
+class TokenBucket():
+
+    def __init__(self, per_minute, burst = None):
+        self.capacity = burst if burst is not None else max(1, per_minute // 6)
+        self.capacity = max(1, min(self.capacity, per_minute - 1))
+        # A full bucket plus a minute of refill must stay within per_minute
+        self.rate = (per_minute - self.capacity) / 60 if per_minute > self.capacity else per_minute / 120
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, tokens = 1):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def drain(self, wait_time = 0):
+        # Negative tokens hold every caller back until wait_time has passed
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, -wait_time * self.rate)
+
+class QuotaStore():
+
+    def __init__(self, path = "quota_usage.json"):
+        self.path = path
+        self._lock = threading.Lock()
+        self.usage = dict()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.usage = json.load(f)
+
+    def _today(self):
+        today = date.today().isoformat()
+        if self.usage.get("date") != today:
+            self.usage = {"date": today, "used": dict()}
+        return self.usage["used"]
+
+    def used(self, name):
+        with self._lock:
+            return self._today().get(name, 0)
+
+    def consume(self, name, limit, amount = 1):
+        with self._lock:
+            used = self._today()
+            if limit is not None and used.get(name, 0) + amount > limit:
+                raise QuotaExceededError("Daily quota of {} requests exhausted for {}".format(limit, name))
+            used[name] = used.get(name, 0) + amount
+            with open(self.path, "w") as f:
+                json.dump(self.usage, f)
+
+class RateLimiter():
+
+    def __init__(self, name, per_minute, per_day = None, store = None):
+        self.name = name
+        self.per_day = per_day
+        self.bucket = TokenBucket(per_minute)
+        self.store = QuotaStore() if store is None else store
+
+    @property
+    def remaining(self):
+        if self.per_day is None: return float("inf")
+        return max(0, self.per_day - self.store.used(self.name))
+
+    def wait(self, amount = 1):
+        if amount > self.remaining:
+            raise QuotaExceededError("Daily quota of {} requests exhausted for {}".format(self.per_day, self.name))
+        self.bucket.acquire(amount)
+
+    def consume(self, amount = 1):
+        self.store.consume(self.name, self.per_day, amount)
+
+    def acquire(self, amount = 1):
+        self.wait(amount)
+        self.consume(amount)
+
+    def throttled(self, wait_time = 60):
+        self.bucket.drain(wait_time)
+
+_limiters = dict()
+_limiters_lock = threading.Lock()
+
+def get_limiter(name, config_path = "config.json"):
+    with _limiters_lock:
+        if (config_path, name) not in _limiters.keys():
+            limits = dict(DEFAULT_LIMITS)
+            config = dict()
+            if os.path.exists(config_path):
+                with open(config_path, "r") as f:
+                    config = json.load(f)
+            limits.update(config.get("rate_limits", dict()))
+
+            store = next((limiter.store for (limiter_config, limiter_name), limiter in _limiters.items() if limiter_config == config_path), None)
+            if store is None: store = QuotaStore(config.get("quota_path", "quota_usage.json"))
+            _limiters[(config_path, name)] = RateLimiter(name, limits[name]["per_minute"], limits[name].get("per_day"), store = store)
+        return _limiters[(config_path, name)]
@@ -0,0 +1,105 @@
+import sqlite3, json, time, hashlib, threading, os
+
+def normalize(value, precision = 5):
+    if isinstance(value, float):
+        return round(value, precision)
+    if isinstance(value, (list, tuple)):
+        return [normalize(entry, precision) for entry in value]
+    if isinstance(value, dict):
+        return {str(key): normalize(entry, precision) for key, entry in sorted(value.items())}
+    return value
+
+class ResponseCache():
+
+    def __init__(self, path = "response_cache.sqlite", ttl = 30*86400, max_entries = 100000, precision = 5):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+        self.hits, self.misses = 0, 0
+        self._entries = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread = False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, namespace TEXT, value TEXT, expires_at REAL, last_access REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._connection.commit()
+            self._entries = self._connection.execute("SELECT COUNT(*) FROM responses WHERE expires_at IS NOT NULL").fetchone()[0]
+        return self._connection
+
+    def key(self, namespace, params):
+        return hashlib.sha1(json.dumps([namespace, normalize(params, self.precision)], sort_keys = True).encode("utf-8")).hexdigest()
+
+    def get(self, namespace, params):
+        key, now = self.key(namespace, params), time.time()
+        with self._lock:
+            row = self.connection.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return None
+
+            self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, namespace, params, value, expire = True):
+        key, now = self.key(namespace, params), time.time()
+        with self._lock:
+            previous = self.connection.execute("SELECT expires_at IS NOT NULL FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, namespace, value, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, namespace, json.dumps(value), now + self.ttl if expire else None, now)
+            )
+            self._entries += int(expire) - (previous[0] if previous is not None else 0)
+            if self._entries > self.max_entries: self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        # Only expiring rows count towards max_entries, rows stored with expire = False are never evicted
+        self.connection.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses WHERE expires_at IS NOT NULL ORDER BY last_access LIMIT ?)",
+            (self._entries - self.max_entries,)
+        )
+        self._entries = self.max_entries
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM responses")
+            self.connection.commit()
+            self._entries = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_connection"], state["_lock"] = None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+_caches = dict()
+
+def get_cache(config_path = "config.json"):
+    if config_path not in _caches.keys():
+        config = dict()
+        if os.path.exists(config_path):
+            with open(config_path, "r") as f:
+                config = json.load(f).get("response_cache", dict())
+
+        _caches[config_path] = ResponseCache(
+            path = config.get("path", "response_cache.sqlite"),
+            ttl = config.get("ttl_days", 30) * 86400,
+            max_entries = config.get("max_entries", 100000)
+        )
+    return _caches[config_path]
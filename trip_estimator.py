@@ -0,0 +1,46 @@
+import numpy as np
+from scipy.stats import spearmanr
+from utils import distance_matrix_km
+
+class TripEstimator():
+
+    def __init__(self, detour_factor = 1.3, speed_kmh = 80):
+        self.detour_factor = detour_factor
+        self.speed_kmh = speed_kmh
+
+    @property
+    def seconds_per_km(self):
+        return self.detour_factor / self.speed_kmh * 3600
+
+    def calibrate(self, group_matrix):
+        straight, road = list(), list()
+        names = list(group_matrix.locations.keys())
+        if len(names) == 0: return self.seconds_per_km
+
+        for gite_key, column in group_matrix.gite_columns.items():
+            durations = [column[name]["duration"] for name in names]
+            kilometers = distance_matrix_km(list(group_matrix.locations.values()), [gite_key])[:, 0]
+            for kilometer, duration in zip(kilometers, durations):
+                if duration is not None and kilometer > 1:
+                    straight.append(kilometer)
+                    road.append(duration)
+
+        if len(straight) > 0:
+            straight, road = np.array(straight), np.array(road)
+            self.detour_factor = float(np.dot(straight, road) / np.dot(straight, straight)) * self.speed_kmh / 3600
+        return self.seconds_per_km
+
+    def estimate(self, participants, gite_locations):
+        locations = [participant.location for participant in participants if participant.location is not None]
+        if len(locations) == 0 or len(gite_locations) == 0: return np.zeros(len(gite_locations))
+
+        return distance_matrix_km(locations, gite_locations).sum(axis = 0) * self.seconds_per_km
+
+    def shortlist(self, participants, possibilities, number):
+        estimates = self.estimate(participants, [possibility.gite.location for possibility in possibilities])
+        order = np.argsort(estimates, kind = "stable")[:number]
+        return [possibilities[i] for i in order], dict(zip(possibilities, estimates.tolist()))
+
+def rank_correlation(estimates, exact):
+    if len(estimates) < 3: return None
+    return float(spearmanr(estimates, exact)[0])
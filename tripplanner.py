@@ -1,6 +1,10 @@
-import json, utils, time, pickle
+import json, utils, time, pickle, heapq
+from concurrent.futures import ThreadPoolExecutor
 from api_google_sheets import TripPlanningSheet
 from possibility import Possibility
+from group_matrix import GroupMatrix
+from trip_estimator import TripEstimator, rank_correlation
+from rate_limiter import get_limiter, QuotaExceededError
 import api_gites, api_sncf, api_car
 from tqdm import tqdm
 
@@ -14,6 +18,8 @@ class TripPlanner():
         self.possibilities = None
         self.gites = None
         self.filtered_gites = None
+        self.group_matrix = None
+        self.estimator = TripEstimator()
 
         self.with_trains = True
 
@@ -46,24 +52,33 @@ class TripPlanner():
         filters = self.sheet.get_filters()
         self.refresh_participants()
         
-        self.gites = api_gites.GitesDeFrance(dates[0], dates[1], self.nb_participants, filters = filters["filters"])
+        # The price sort parameters are unverified against the site, so sorted searches are opt-in
+        order = api_gites.FilterOrder.ASC if self.config.get("sorted_gite_search", False) else None
+        self.gites = api_gites.GitesDeFrance(dates[0], dates[1], self.nb_participants, filters = filters["filters"], order = order)
 
         self.filtered_gites = list()
         total_budget = self.total_budget
         min_price = self.config["min_price"] * self.nb_participants * (self.gites.checkout_datetime - self.gites.checkin_datetime).total_seconds()/86400
-        for gite in tqdm(self.gites):
+        for gite in tqdm(self.gites.iter_below_price(total_budget), total = len(self.gites)):
             if min_price < gite.price < total_budget:
                 if filters["max_beds_in_bedroom"] is None or self.nb_participants is None or (gite.bedrooms is not None and self.nb_participants / gite.bedrooms >= filters["max_beds_in_bedroom"]):
                     self.filtered_gites.append(gite)
         
+        if self.gites.sorted_by_price and self.gites.pages_loaded < self.gites.nb_pages:
+            print("Stopped after {}/{} pages: the remaining gites are above the budget".format(self.gites.pages_loaded, self.gites.nb_pages))
         return self.filtered_gites
 
     def refresh_possibilities(self):
         participants = self.refresh_participants()
+        if self.group_matrix is None:
+            self.group_matrix = GroupMatrix(api_ors = api_car.OpenRouteService(config_path = self.config_path))
+        self.group_matrix.set_participants(participants)
+
         if self.possibilities is None or len(self.possibilities) == 0:
-            self.possibilities = [Possibility(self.participants, gite, with_trains = self.with_trains) for gite in self.get_gites()]
+            self.possibilities = [Possibility(self.participants, gite, with_trains = self.with_trains, group_matrix = self.group_matrix) for gite in self.get_gites()]
         else:
             for possibility in self.possibilities:
+                possibility.group_matrix = self.group_matrix
                 possibility.set_participants(participants)
 
         return self.possibilities
@@ -72,26 +87,48 @@ class TripPlanner():
     def total_budget(self):
         return sum([participant.budget for participant in self.participants])
 
-    def filter_possibilities(self, output_number = 10, price_filter_number = 50):
+    def filter_possibilities(self, output_number = 10, price_filter_number = 50, shortlist_number = 20):
         if self.possibilities is None:
             self.refresh_possibilities()
         possibilities_showed = [p for p in self.possibilities if p.sheet_id is not None]
 
-        price_filtered = list()
-        while len(price_filtered) < price_filter_number:
-            filtered_possibilities = [p for p in sorted(self.possibilities, key = lambda p: p.gite.price) if not p in price_filtered and p.sheet_id is None and not p.rejected]
-            if len(filtered_possibilities) > 0:
-                if utils.is_in_france(filtered_possibilities[0].gite.location):
-                    price_filtered.append(filtered_possibilities[0])
-                else:
-                    self.possibilities.remove(filtered_possibilities[0])
+        # The index breaks price ties in list order, like the stable sort it replaces
+        candidates = [(p.gite.price, i, p) for i, p in enumerate(self.possibilities) if p.sheet_id is None and not p.rejected]
+        heapq.heapify(candidates)
+        api_gites.GitesDeFrance.prefetch_locations([p.gite for price, i, p in heapq.nsmallest(price_filter_number, candidates)])
+
+        price_filtered, outside_france = list(), set()
+        while len(price_filtered) < price_filter_number and len(candidates) > 0:
+            possibility = heapq.heappop(candidates)[2]
+            if utils.is_in_france(possibility.gite.location):
+                price_filtered.append(possibility)
             else:
-                break
+                outside_france.add(possibility)
+
+        if len(outside_france) > 0:
+            self.possibilities = [p for p in self.possibilities if p not in outside_france]
         
         if len(price_filtered) + len(possibilities_showed) == 0: return []
+
+        estimates = None
+        if shortlist_number is not None and len(price_filtered) > shortlist_number:
+            if self.group_matrix is not None: self.estimator.calibrate(self.group_matrix)
+            price_filtered, estimates = self.estimator.shortlist(self.participants, price_filtered, shortlist_number)
+
+        if self.group_matrix is not None:
+            price_filtered = self.matrix_budget(price_filtered)
+            try:
+                self.group_matrix.prefetch([p.gite.location for p in price_filtered])
+            except QuotaExceededError as e:
+                print(e)
                 
-        distance_filtered = sorted(price_filtered, key = lambda p: p.total_trip_time)[:output_number - len(possibilities_showed)]
-        next_index = max([p.number for p in self.possibilities if p.number > 0]) + 1 if len([1 for p in self.possibilities if p.number > 0]) > 0 else 1
+        trip_times = self.evaluate_trip_times(price_filtered)
+        price_filtered = [p for p in price_filtered if p in trip_times.keys()]
+        if estimates is not None:
+            correlation = rank_correlation([estimates[p] for p in price_filtered], [trip_times[p] for p in price_filtered])
+            if correlation is not None: print("Trip time estimator rank correlation: {:.2f} over {} gites".format(correlation, len(price_filtered)))
+        distance_filtered = heapq.nsmallest(output_number - len(possibilities_showed), price_filtered, key = lambda p: trip_times[p])
+        next_index = max((p.number for p in self.possibilities), default = 0) + 1
         
         for possibility in distance_filtered:
             if possibility.number == 0:
@@ -100,20 +137,82 @@ class TripPlanner():
 
         return possibilities_showed + distance_filtered
 
+    def solve_possibilities(self, possibilities):
+        with ThreadPoolExecutor(max_workers = self.config.get("max_workers", 8)) as executor:
+            Possibility.set_solutions(possibilities, executor, max_processes = self.config.get("solver_processes"))
+
+    def solve_within_quota(self, possibilities):
+        try:
+            self.solve_possibilities(possibilities)
+            return possibilities
+        except QuotaExceededError as e:
+            print(e)
+
+        # Solved one by one, the possibilities whose matrices are already fetched or cached still get a solution
+        solved = list()
+        for possibility in possibilities:
+            try:
+                if not possibility._solution_set: possibility.refresh_solution()
+            except QuotaExceededError:
+                possibility.reset_solution()
+                continue
+            solved.append(possibility)
+        print("Not enough ORS matrix quota left, solved {} gites out of {}".format(len(solved), len(possibilities)))
+        return solved
+
+    def evaluate_trip_times(self, possibilities):
+        possibilities = self.solve_within_quota(possibilities)
+        with ThreadPoolExecutor(max_workers = self.config.get("max_workers", 8)) as executor:
+            trip_times = list(executor.map(lambda p: p.total_trip_time, possibilities))
+
+        return dict(zip(possibilities, trip_times))
+
     @property
     def rejected_possibilities(self):
         if self.possibilities is None or len(self.possibilities) == 0: return None
         
         return [p for p in self.possibilities if p.rejected and not p.invalid]
 
+    def matrix_budget(self, possibilities):
+        remaining = get_limiter("ors_matrix", self.config_path).remaining
+        # Train users add a station row and column to their calculator matrix
+        reserve = 2 if self.with_trains else 0
+        for number in range(len(possibilities), -1, -1):
+            requests = self.group_matrix.prefetch_requests([p.gite.location for p in possibilities[:number]])
+            requests += reserve * len([p for p in possibilities[:number] if not p._solution_set])
+            if requests <= remaining: break
+
+        if number < len(possibilities):
+            print("Not enough ORS matrix quota left, evaluating {} gites out of {}".format(number, len(possibilities)))
+        return possibilities[:number]
+
+    def routing_budget(self, possibilities):
+        remaining = get_limiter("ors_directions", self.config_path).remaining
+        budgeted = list()
+        for possibility in possibilities:
+            if not possibility._route_set:
+                remaining -= len(possibility.covoit_calculator.drivers)
+            if remaining < 0:
+                print("Not enough ORS directions quota left, showing {} results out of {}".format(len(budgeted), len(possibilities)))
+                break
+            budgeted.append(possibility)
+
+        return budgeted
+
     def refresh_results(self, **kwargs):
         self.sheet.delete_rejected(self.possibilities)
         filtered_possibilities = self.filter_possibilities(**kwargs)
+        filtered_possibilities = self.solve_within_quota(filtered_possibilities)
+        filtered_possibilities = self.routing_budget(filtered_possibilities)
         for possibility in filtered_possibilities:
             try:
                 possibility.set_routes()
             except api_car.InvalidLocationError:
                 continue
+            except QuotaExceededError as e:
+                print(e)
+                filtered_possibilities = [p for p in filtered_possibilities if p._route_set or p.invalid]
+                break
         self.sheet.print_results(filtered_possibilities + self.rejected_possibilities, len(self.possibilities))
         
     def to_file(self, file_name):
@@ -121,7 +220,8 @@ class TripPlanner():
             "config_path": self.config_path,
             "possibilities": self.possibilities,
             "gites": self.gites,
-            "filtered_gites": self.filtered_gites
+            "filtered_gites": self.filtered_gites,
+            "group_matrix": self.group_matrix
         }
         with open(file_name, 'wb') as f:
             pickle.dump(output, f)
@@ -135,6 +235,7 @@ class TripPlanner():
         output.possibilities = data["possibilities"]
         output.gites = data["gites"]
         output.filtered_gites = data["filtered_gites"]
+        output.group_matrix = data.get("group_matrix")
         
         return output
         
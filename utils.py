@@ -1,74 +1,131 @@
-from math import sin, cos, sqrt, atan2, radians, asin, degrees
-import urllib.request, urllib.parse
-import os, json
+import urllib.parse
+import os, json, csv
 import time
 import paramiko, pysftp
 from base64 import decodebytes
 import numpy as np
+from scipy.spatial import cKDTree
+from binary_cache import BinaryCache
+from http_client import get_client
 
 radius = 6373.0
 
-def distance_km(from_point, to_point):
-    lat1, lon1 = radians(from_point[0]), radians(from_point[1])
-    lat2, lon2 = radians(to_point[0]), radians(to_point[1])
-    dlon = lon1 - lon2
-    dlat = lat1 - lat2
-    a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+def as_points(points):
+    return np.asarray(points, dtype = np.float64).reshape(-1, 2)
 
-    return c * radius
+def haversine_km_rad(lat1, lon1, lat2, lon2):
+    a = np.sin((lat2 - lat1)/2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2.0)**2
+    return 2 * radius * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
 
-def min_distance_km_np(lat1, lon1, lat2, lon2):
-    lon1, lat1, lon2, lat2 = map(np.array, [lon1, lat1, lon2, lat2])
-    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+def haversine_km_np(lat1, lon1, lat2, lon2):
+    return haversine_km_rad(*map(np.radians, [lat1, lon1, lat2, lon2]))
 
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
+def distances_km(from_points, to_points):
+    from_points, to_points = as_points(from_points), as_points(to_points)
+    return haversine_km_np(from_points[:, 0], from_points[:, 1], to_points[:, 0], to_points[:, 1])
+
+def distance_matrix_km(from_points, to_points):
+    from_points, to_points = np.radians(as_points(from_points)), np.radians(as_points(to_points))
+    return haversine_km_rad(from_points[:, 0, None], from_points[:, 1, None], to_points[None, :, 0], to_points[None, :, 1])
+
+def distance_km(from_point, to_point):
+    return float(haversine_km_np(from_point[0], from_point[1], to_point[0], to_point[1]))
+
+def min_distance_km_np(lat1, lon1, lat2, lon2):
+    return np.min(haversine_km_np(*map(np.asarray, [lat1, lon1, lat2, lon2])))
 
-    a = np.sin(dlat/2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2.0)**2
+def polyline_distances_km(points):
+    points = as_points(points)
+    return distances_km(points[:-1], points[1:])
 
-    c = 2 * np.arcsin(np.sqrt(a))
-    km = 6373 * c
-    return np.min(km)
+def polyline_distance_km(points):
+    return float(np.sum(polyline_distances_km(points)))
 
 def trace_distance_km(trace):
-    distance_sum = 0
-    prev_point = trace[0]
-    for point in trace[1:]:
-        distance_sum += distance_km(prev_point, point)
+    return polyline_distance_km(trace)
 
-    return distance_sum
+def line_bearings(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    dlon = lon2 - lon1
+    return np.arctan2(np.sin(dlon) * np.cos(lat2), np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon))
 
 def get_line_bearing(lat1, lon1, lat2, lon2):
-    lat1, lon1 = radians(lat1), radians(lon1)
-    lat2, lon2 = radians(lat2), radians(lon2)
-    dlat = lon2-lon1
-    val_rad = atan2( sin(dlat)*cos(lat2) , cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlat))
-    return val_rad
+    return float(line_bearings(lat1, lon1, lat2, lon2))
+
+def points_bearing_distance(lat, lon, bearing, distance):
+    lat, lon, angle = np.radians(lat), np.radians(lon), np.asarray(distance) / radius
+    point_lat = np.arcsin(np.sin(lat) * np.cos(angle) + np.cos(lat) * np.sin(angle) * np.cos(bearing))
+    point_lon = lon + np.arctan2(np.sin(bearing) * np.sin(angle) * np.cos(lat), np.cos(angle) - np.sin(lat) * np.sin(point_lat))
+    return np.degrees(point_lat), np.degrees(point_lon)
 
 def point_bearing_distance(lat, lon, bearing, distance):
-    lat, lon = radians(lat), radians(lon)
-    point_lat = asin( sin(lat)*cos(distance/radius) + cos(lat)*sin(distance/radius)*cos(bearing))
-    point_lon = lon + atan2(sin(bearing)*sin(distance/radius)*cos(lat), cos(distance/radius)-sin(lat)*sin(point_lat))
-    return degrees(point_lat), degrees(point_lon)
+    point_lat, point_lon = points_bearing_distance(lat, lon, bearing, distance)
+    return float(point_lat), float(point_lon)
+
+def interpolate_polyline(points, step_km = 5):
+    points = as_points(points)
+    from_points, to_points = points[:-1], points[1:]
+    bearings = line_bearings(from_points[:, 0], from_points[:, 1], to_points[:, 0], to_points[:, 1])
+    counts = -(-polyline_distances_km(points).astype(np.int64) // step_km)
+
+    segment_ids = np.repeat(np.arange(len(from_points)), counts)
+    steps = (np.arange(len(segment_ids)) - np.repeat(np.cumsum(counts) - counts, counts)) * step_km
+    interpolated = np.stack(points_bearing_distance(from_points[segment_ids, 0], from_points[segment_ids, 1], bearings[segment_ids], steps), axis = 1)
+
+    output = np.empty((len(points) + len(interpolated), 2))
+    original_ids = np.concatenate([[0], np.cumsum(counts + 1)])
+    is_original = np.zeros(len(output), dtype = bool)
+    is_original[original_ids] = True
+    output[is_original], output[~is_original] = points, interpolated
+    return output
 
 def interpolate_segment(from_point, to_point, step_km = 5):
-    points = list()
-    segment_distance = distance_km(from_point, to_point)
-    bearing = get_line_bearing(from_point[0], from_point[1], to_point[0], to_point[1])
+    return interpolate_polyline([from_point, to_point], step_km = step_km)[1:-1].tolist()
 
-    for distance in range(0, int(segment_distance), step_km):
-        points.append(list(point_bearing_distance(from_point[0], from_point[1], bearing, distance)))
+def interpolate_segments(points, step_km = 5):
+    return interpolate_polyline(points, step_km = step_km).tolist()
 
-    return points
+def to_unit_vectors(points):
+    points = np.radians(np.asarray(points, dtype = np.float64).reshape(-1, 2))
+    lat, lon = points[:, 0], points[:, 1]
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis = 1)
 
-def interpolate_segments(points, step_km = 5):
-    output = [points[0],]
-    for point in points[1:]:
-        output += interpolate_segment(output[-1], point, step_km = step_km)
-        output.append(point)
+def chord_to_km(chord):
+    return 2 * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1)) * radius
 
-    return output
+def km_to_chord(distance):
+    return 2 * np.sin(np.minimum(np.asarray(distance) / radius, np.pi) / 2)
+
+class SphericalIndex():
+
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+        self.tree = cKDTree(to_unit_vectors(self.points)) if len(self.points) > 0 else None
+
+    def __len__(self):
+        return len(self.points)
+
+    def nearest(self, points, k = 1):
+        points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+        if self.tree is None:
+            return np.full((len(points), k), np.inf), np.full((len(points), k), -1, dtype = np.int64)
+
+        chords, indices = self.tree.query(to_unit_vectors(points), k = min(k, len(self)))
+        chords, indices = np.asarray(chords).reshape(len(points), -1), np.asarray(indices).reshape(len(points), -1)
+        return chord_to_km(chords), indices
+
+    def in_radius(self, points, distance):
+        points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+        if self.tree is None: return [np.zeros(0, dtype = np.int64) for point in points]
+
+        output = list()
+        for point, candidates in zip(points, self.tree.query_ball_point(to_unit_vectors(points), km_to_chord(distance))):
+            candidates = np.array(sorted(candidates), dtype = np.int64)
+            if len(candidates) > 0:
+                candidates = candidates[haversine_km_np(point[0], point[1], self.points[candidates, 0], self.points[candidates, 1]) < distance]
+            output.append(candidates)
+
+        return output
 
 def is_in_france(location):
     return distance_km([46.452547, 2.404213], location) < 600
@@ -88,27 +145,62 @@ def nocache(link):
     link += "nocache={:.0f}".format(time.time())
     return link
 
+def download_if_not_exist(url, path):
+    if not os.path.exists(path):
+        print("Downloading {} ...".format(path))
+        get_client().download(url, path)
+        print("Completed")
+
+def read_csv_export(url, path, delimiter = ";"):
+    download_if_not_exist(url, path)
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f, delimiter = delimiter):
+            yield row
+
 class GeoCoder():
     
-    def __init__(self):
-        if not os.path.exists("villes_laposte.json"):
-            print("Downloading villes_laposte.json ...")
-            urllib.request.urlretrieve("https://datanova.legroupe.laposte.fr/explore/dataset/laposte_hexasmal/download/?format=json&timezone=Europe/Berlin&lang=fr", "villes_laposte.json")
-            print("Completed")
-            
-        with open("villes_laposte.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
-        self.villes = dict()
-        
-        for ville in data:
-            if "coordonnees_gps" not in ville["fields"]:
-                continue
+    def __init__(self, cache_path = "villes_laposte_cache"):
+        self.cache = BinaryCache(cache_path, sources = ["villes_laposte.json", "villes_laposte.csv"])
+        if not self.cache.is_valid:
+            self._build_cache()
+
+        arrays, meta = self.cache.load()
+        self.names, self.locations = arrays["names"], arrays["locations"]
+        self.index = SphericalIndex(self.locations)
+
+    def _build_cache(self):
+        villes = dict()
+        if os.path.exists("villes_laposte.json"):
+            with open("villes_laposte.json", "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            for ville in data:
+                if "coordonnees_gps" not in ville["fields"]:
+                    continue
+
+                villes[ville["fields"]["nom_de_la_commune"]] = ville["fields"]["coordonnees_gps"]
+        else:
+            for ville in read_csv_export("https://datanova.legroupe.laposte.fr/explore/dataset/laposte_hexasmal/download/?format=csv&use_labels_for_header=false&timezone=Europe/Berlin&lang=fr", "villes_laposte.csv"):
+                if ville.get("coordonnees_gps") in ("", None):
+                    continue
+
+                villes[ville["nom_de_la_commune"]] = [float(coordinate) for coordinate in ville["coordonnees_gps"].split(",")]
+
+        self.cache.save({
+            "names": np.array(list(villes.keys()), dtype = np.str_),
+            "locations": np.array(list(villes.values()), dtype = np.float64).reshape(-1, 2)
+        })
+
+    @property
+    def villes(self):
+        return {str(name): location.tolist() for name, location in zip(self.names, self.locations)}
+
+    def geocode_many(self, points):
+        distances, indices = self.index.nearest(points)
+        return [str(name) for name in self.names[indices[:, 0]]]
 
-            self.villes[ville["fields"]["nom_de_la_commune"]] = ville["fields"]["coordonnees_gps"]
-        
     def geocode(self, lat, lon):
-        return min(self.villes.items(), key = lambda x : distance_km(x[1], [lat, lon]))[0]
+        return self.geocode_many([[lat, lon]])[0]
 
 class SftpClient():
 